@@ -1,4 +1,10 @@
+import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 1024  # color histograms per chunk, 1024 x 768 float32 = 3 MiB scratch, stays in cache
+SPARSE_BUDGET = 2**20  # max number of float32 elements in temporary of query bins times stored non-zero bins (4 MiB, stays in cache)
+WIDEN_BUDGET = 2**18  # max number of float32 elements in scratch of dense compact histograms widened for matrix multiplication (1 MiB, stays in cache)
 
 
 def colorHistsDistanceL2(color_hist_1, color_hist_2):
@@ -18,12 +24,22 @@ def colorHistsDistanceL2(color_hist_1, color_hist_2):
     return distance
 
 
-def colorHistsMultipleDistancesL2(color_hists_array, color_hist):
+def _chunkDistancesL2(color_hists_chunk, color_hist, scratch, out):
+    """Distances of a chunk of color histograms to color histogram, computed inside preallocated scratch (no allocations)."""
+    difference = scratch[:len(color_hists_chunk)]
+    np.subtract(color_hists_chunk, color_hist[np.newaxis], out=difference)
+    np.square(difference, out=difference)
+    difference.sum(axis=1, out=out)
+    np.sqrt(out, out=out)
+
+
+def colorHistsMultipleDistancesL2(color_hists_array, color_hist, chunk_size=CHUNK_SIZE):
     """Calculate Euclidean distances (L2) between array of color histograms and another color histogram.
 
     Args:
         color_hists_array: numpy array float32, color histograms of shape [number_of_color_histograms, histogram_length]
         color_hist: numpy array float32, color histogram
+        chunk_size: int, number of color histograms processed at once, bounds temporary memory to [chunk_size, histogram_length]
 
     Return:
         distances: numpy array float32, Euclidian distances between array of color histograms and given color histogram.
@@ -31,10 +47,203 @@ def colorHistsMultipleDistancesL2(color_hists_array, color_hist):
     Note: histograms treated here as vectors (Euclidean distance between vectors).
     For this to make sense they should be of the same length (same histSize), and belong to same vector space (same ranges).
     """
-    distance = np.sqrt(np.square(color_hists_array - color_hist[np.newaxis]).sum(axis=1))
+    dtype = np.result_type(color_hists_array, color_hist)
+    number_of_color_hists, histogram_length = color_hists_array.shape
+
+    # one scratch buffer reused for every chunk, instead of temporary as large as the whole array
+    scratch = np.empty((min(chunk_size, number_of_color_hists), histogram_length), dtype=dtype)
+    distance = np.empty(number_of_color_hists, dtype=dtype)
+    for start in range(0, number_of_color_hists, chunk_size):
+        end = min(start + chunk_size, number_of_color_hists)
+        _chunkDistancesL2(color_hists_array[start:end], color_hist, scratch, distance[start:end])
     return distance
 
 
+def _mergeTopk(indices, distances, topk):
+    """Keep topk closest, ordered by distance, ties by index (so that result does not depend on chunking)."""
+    order = np.lexsort((indices, distances))[:topk]
+    return indices[order], distances[order]
+
+
+def _colorHistsTopkL2Range(color_hists_array, color_hist, topk, start, end, chunk_size):
+    """Running topk over rows [start, end) of color_hists_array, chunk by chunk."""
+    dtype = np.result_type(color_hists_array, color_hist)
+    scratch = np.empty((min(chunk_size, end - start), color_hists_array.shape[1]), dtype=dtype)
+    chunk_distances = np.empty(min(chunk_size, end - start), dtype=dtype)
+
+    top_indices = np.empty(0, dtype=np.int64)
+    top_distances = np.empty(0, dtype=dtype)
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        distances = chunk_distances[:chunk_end - chunk_start]
+        _chunkDistancesL2(color_hists_array[chunk_start:chunk_end], color_hist, scratch, distances)
+
+        top_indices, top_distances = _mergeTopk(np.concatenate((top_indices, np.arange(chunk_start, chunk_end))),
+                                                np.concatenate((top_distances, distances)), topk)
+    return top_indices, top_distances
+
+
+def colorHistsTopkL2(color_hists_array, color_hist, topk, chunk_size=CHUNK_SIZE, n_jobs=1):
+    """Find topk color histograms of array closest (L2) to another color histogram, streaming over array in chunks.
+
+    Peak memory depends on chunk_size and topk only, not on number of color histograms, so array can be memory-mapped and larger than RAM.
+
+    Args:
+        color_hists_array: numpy array float32, color histograms of shape [number_of_color_histograms, histogram_length]
+        color_hist: numpy array float32, color histogram
+        topk: int
+        chunk_size: int, number of color histograms processed at once (per thread)
+        n_jobs: int, number of threads to split array between, None - as many as CPU cores
+
+    Return:
+        top_indices: numpy array int64, of shape [min(topk, number_of_color_histograms)], ordered by ascending distance (ties by index)
+        top_distances: numpy array float32, respective Euclidean distances
+    """
+    number_of_color_hists = color_hists_array.shape[0]
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    if n_jobs == 1 or number_of_color_hists <= chunk_size:
+        return _colorHistsTopkL2Range(color_hists_array, color_hist, topk, 0, number_of_color_hists, chunk_size)
+
+    # contiguous ranges of whole chunks per thread, numpy releases the GIL inside arithmetic on chunks
+    number_of_chunks = -(-number_of_color_hists // chunk_size)
+    bounds = [min(number_of_color_hists, chunk_size * (number_of_chunks * i // n_jobs)) for i in range(n_jobs + 1)]
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(lambda start, end: _colorHistsTopkL2Range(color_hists_array, color_hist, topk, start, end, chunk_size),
+                                    bounds[:-1], bounds[1:]))
+
+    return _mergeTopk(np.concatenate([indices for indices, _ in results]), np.concatenate([distances for _, distances in results]), topk)
+
+
+def colorHistsSquaredNormsL2(color_hists_array):
+    """Calculate squared Euclidean norms of color histograms, to be precomputed once per dataset for colorHistsPairwiseDistancesL2.
+
+    Args:
+        color_hists_array: numpy array float32, color histograms of shape [number_of_color_histograms, histogram_length]
+
+    Return:
+        squared_norms: numpy array float64, of shape [number_of_color_histograms]
+    """
+    squared_norms = np.einsum('ij,ij->i', color_hists_array, color_hists_array, dtype=np.float64)
+    return squared_norms
+
+
+def colorHistsPairwiseDistancesL2(color_hists_array, query_color_hists, color_hists_squared_norms=None):
+    """Calculate Euclidean distances (L2) between every query color histogram and every color histogram of array.
+
+    Uses expansion ||a - b||^2 = ||a||^2 - 2ab + ||b||^2, so that the bulk of work is a single matrix multiplication
+    and no temporary of size [number_of_color_histograms, histogram_length] is created.
+    Dot products are in float32, so distances between nearly identical histograms carry rounding error of float32.
+
+    Args:
+        color_hists_array: numpy array float32, color histograms of shape [number_of_color_histograms, histogram_length]
+        query_color_hists: numpy array float32, color histograms of shape [number_of_queries, histogram_length]
+        color_hists_squared_norms: numpy array float64, output of colorHistsSquaredNormsL2 for color_hists_array. If None - calculate
+
+    Return:
+        distances: numpy array float64, of shape [number_of_queries, number_of_color_histograms]
+    """
+    if color_hists_squared_norms is None:
+        color_hists_squared_norms = colorHistsSquaredNormsL2(color_hists_array)
+    query_squared_norms = colorHistsSquaredNormsL2(query_color_hists)
+
+    squared_distances = query_color_hists @ color_hists_array.T
+    squared_distances = query_squared_norms[:, np.newaxis] - 2 * squared_distances + color_hists_squared_norms[np.newaxis]
+
+    # rounding can push distances of (nearly) identical histograms slightly below zero
+    distances = np.sqrt(np.maximum(squared_distances, 0, out=squared_distances), out=squared_distances)
+    return distances
+
+
+def _sparseDots(compact_hists, query_color_hists, dots, block_size):
+    """Dot products of queries with sparse (CSR) stored histograms, written into dots [number_of_queries, number_of_color_hists].
+
+    Products of non-zero bins with respective query bins are gathered into a temporary of at most SPARSE_BUDGET elements:
+    queries are split into chunks and stored histograms into blocks (of at most block_size rows) by their number of non-zero bins.
+    """
+    indptr = compact_hists['indptr']
+    number_of_queries, histogram_length = query_color_hists.shape
+    number_of_color_hists = indptr.shape[0] - 1
+
+    # no stored histogram has more than histogram_length non-zero bins, so a block of at least one row always fits
+    query_chunk_size = max(1, min(number_of_queries, SPARSE_BUDGET // histogram_length))
+    block_nnz = max(SPARSE_BUDGET // query_chunk_size, histogram_length)
+
+    for query_start in range(0, number_of_queries, query_chunk_size):
+        queries = query_color_hists[query_start:query_start + query_chunk_size]
+        query_rows = slice(query_start, query_start + len(queries))
+
+        start = 0
+        while start < number_of_color_hists:
+            end = min(start + block_size, int(np.searchsorted(indptr, indptr[start] + block_nnz, side='right')) - 1)
+            end = max(end, start + 1)
+
+            block_indptr = indptr[start:end + 1]
+            indices = compact_hists['indices'][block_indptr[0]:block_indptr[-1]]
+            values = compact_hists['values'][block_indptr[0]:block_indptr[-1]]
+            if len(values) == 0:
+                dots[query_rows, start:end] = 0
+                start = end
+                continue
+
+            # products of non-zero bins with respective query bins, summed per stored histogram.
+            # reduceat only over non-empty rows: their starts are strictly increasing, and each sum ends where the next one starts
+            # (empty rows would yield a single element instead of zero, or cut the previous row short if they end the block)
+            products = queries[:, indices] * values[np.newaxis]
+            non_empty = block_indptr[:-1] != block_indptr[1:]
+            dots[query_rows, start:end] = 0
+            dots[query_rows, start:end][:, non_empty] = np.add.reduceat(products, block_indptr[:-1][non_empty] - block_indptr[0], axis=1)
+            start = end
+
+
+def compactColorHistsPairwiseDistancesL2(compact_hists, query_color_hists, block_size=4096):
+    """Calculate Euclidean distances (L2) between every query color histogram and every color histogram stored in compact form.
+
+    Works in compressed domain: stored histograms are never expanded back to float32 as a whole, only a block at a time
+    (dense storages, block fits into WIDEN_BUDGET), or not at all (sparse storage: dot products are gathered straight from non-zero bins, see SPARSE_BUDGET).
+    Dense blocks are widened into a scratch reused for every block, dot products come from float32 matrix multiplication,
+    and per row scales of uint8 storage are applied to the dot products afterwards, not to the stored values.
+    Dot products are not computed in uint8/float16 themselves: numpy has no BLAS kernel for them, its integer and float16 matrix
+    multiplications are 10-150x slower than widening plus float32 one (and quantizing queries would cost accuracy).
+    Uses the same expansion ||a - b||^2 = ||a||^2 - 2ab + ||b||^2 as colorHistsPairwiseDistancesL2, with norms stored alongside compact histograms.
+
+    Args:
+        compact_hists: dict, output of compact.compressColorHists
+        query_color_hists: numpy array float32, normalized color histograms (compact.normalizeColorHists) of shape [number_of_queries, histogram_length]
+        block_size: int, maximum number of stored histograms to process at once
+
+    Return:
+        distances: numpy array float64, of shape [number_of_queries, number_of_color_histograms]
+    """
+    query_color_hists = np.atleast_2d(np.asarray(query_color_hists, dtype=np.float32))
+    squared_norms = compact_hists['squared_norms']
+    number_of_color_hists = squared_norms.shape[0]
+
+    dots = np.empty((query_color_hists.shape[0], number_of_color_hists), dtype=np.float64)
+    if compact_hists['storage'] == 'sparse':
+        _sparseDots(compact_hists, query_color_hists, dots, block_size)
+    else:
+        values = compact_hists['values']
+        block_size = max(1, min(block_size, WIDEN_BUDGET // values.shape[1], number_of_color_hists))
+        widened = np.empty((block_size, values.shape[1]), dtype=np.float32)
+        block_dots = np.empty((query_color_hists.shape[0], block_size), dtype=np.float32)
+        for start in range(0, number_of_color_hists, block_size):
+            end = min(start + block_size, number_of_color_hists)
+            block = widened[:end - start]
+            np.copyto(block, values[start:end])
+            np.matmul(query_color_hists, block.T, out=block_dots[:, :end - start])
+            if compact_hists['storage'] == 'uint8':
+                np.divide(block_dots[:, :end - start], compact_hists['scales'][start:end][np.newaxis], out=dots[:, start:end])
+            else:
+                dots[:, start:end] = block_dots[:, :end - start]
+
+    query_squared_norms = colorHistsSquaredNormsL2(query_color_hists)
+    squared_distances = query_squared_norms[:, np.newaxis] - 2 * dots + squared_norms[np.newaxis]
+    distances = np.sqrt(np.maximum(squared_distances, 0, out=squared_distances), out=squared_distances)
+    return distances
+
+
 if __name__ == "__main__":
     # sanity check
     h1 = np.array([5, 0, 3, 4], dtype=np.float32)
@@ -50,3 +259,13 @@ if __name__ == "__main__":
     gt_distances = np.array([2.0, 6.0])
     print("Do multiple distances match?\n", c_distances == gt_distances)
     # if you see True printed everything works fine
+
+    c_top_indices, c_top_distances = colorHistsTopkL2(h_arr, h, topk=1, chunk_size=1, n_jobs=2)
+    print("Does chunked topk match?\n", c_top_indices[0] == 0 and c_top_distances[0] == 2.0)
+    # if you see True printed everything works fine
+
+    h_queries = np.array([[4, 1, 2, 3], [5, 0, 3, 4]], dtype=np.float32)
+    c_pairwise_distances = colorHistsPairwiseDistancesL2(h_arr, h_queries)
+    gt_pairwise_distances = np.array([[2.0, 6.0], [0.0, np.sqrt(40.0)]])
+    print("Do pairwise distances match?\n", np.allclose(c_pairwise_distances, gt_pairwise_distances))
+    # if you see True printed everything works fine
@@ -1,5 +1,24 @@
+import os
+import re
+import time
 import numpy as np
-from query import find_similar_by_color_histograms
+from query import find_similar_by_color_histograms, find_similar_by_color_histograms_batch
+
+UKBENCH_GROUP_SIZE = 4  # ukbench consists of groups of 4 consecutive images of the same object
+
+
+def ukbench_group_ids(imgs_paths):
+    """Ground truth group of each image, derived from ukbench naming (ukbenchXXXXX.jpg, XXXXX // 4 - group).
+
+    Args:
+        imgs_paths: list of strings
+
+    Return:
+        group_ids: numpy array int64, of shape [number_of_images]
+    """
+    numbers = [int(re.search(r'(\d+)', os.path.basename(path)).group(1)) for path in imgs_paths]
+    group_ids = np.array(numbers, dtype=np.int64) // UKBENCH_GROUP_SIZE
+    return group_ids
 
 
 def PRcurve(imgs_paths, imgs_color_hists, query_color_hist, topk, query_ground_truth_paths):
@@ -45,12 +64,12 @@ def PRcurve(imgs_paths, imgs_color_hists, query_color_hist, topk, query_ground_t
 
     ordered_paths = find_similar_by_color_histograms(imgs_paths, imgs_color_hists, query_color_hist, topk)
 
-    # find indices of occurrences of ground truth values in full ordered output
-    tp_idx = np.where(np.in1d(ordered_paths, query_ground_truth_paths))[0]
-
-    # leverage the fact that number of true positives changes only at moments we determined above
-    for idx in tp_idx:
-        tp[idx:] += 1
+    # mark occurrences of ground truth values in full ordered output,
+    # number of true positives changes only at these moments, so it is a cumulative sum of marks
+    tp[:len(ordered_paths)] = np.cumsum(np.isin(ordered_paths, query_ground_truth_paths))
+    # cutoffs past the number of images return nothing new, true positives stay as they were at the last image
+    if 0 < len(ordered_paths) < topk:
+        tp[len(ordered_paths):] = tp[len(ordered_paths) - 1]
 
     sample_size = np.arange(1, topk+1)       # vector containing values for each cutoff, except 0 for which precision is not well defined
 
@@ -63,18 +82,81 @@ def PRcurve(imgs_paths, imgs_color_hists, query_color_hist, topk, query_ground_t
     return curve
 
 
+def evaluate_all_queries(imgs_paths, imgs_color_hists, group_ids, topk=None, query_batch_size=256):
+    """Evaluate retrieval using every image of the dataset as a query, ground truth - images of the same group (query itself included, as in PRcurve).
+
+    Rankings of a batch of queries come from a single batched search, relevance is a comparison of integer group ids,
+    true positives - cumulative sums along rankings, so there are no per query Python loops.
+
+    Args:
+        imgs_paths: list of strings
+        imgs_color_hists: numpy array float32, of shape [number_of_images, histogram_length]
+        group_ids: numpy array of ints, of shape [number_of_images], e.g. output of ukbench_group_ids
+        topk: int, length of rankings to evaluate. If None - whole dataset (exact average precision)
+        query_batch_size: int, number of queries evaluated at once, bounds memory to [query_batch_size, topk]
+
+    Return:
+        report: dict, with keys
+            'number_of_queries', 'topk': ints
+            'mAP': float, mean average precision (over cutoffs up to topk)
+            'ns_score': float, ukbench N-S score: mean number of group members among first UKBENCH_GROUP_SIZE results
+            'mean_pr_curve': list of [recall, precision] pairs, averaged over queries, for cutoffs 1..topk
+            'seconds': float, wall time of evaluation
+    """
+    start_time = time.perf_counter()
+
+    group_ids = np.asarray(group_ids)
+    number_of_queries = len(group_ids)
+    if topk is None:
+        topk = number_of_queries
+    topk = min(topk, number_of_queries)
+
+    _, group_ids_dense = np.unique(group_ids, return_inverse=True)
+    gt_sizes = np.bincount(group_ids_dense)[group_ids_dense]
+    sample_size = np.arange(1, topk + 1)
+
+    average_precision_sum = 0.
+    ns_score_sum = 0.
+    curve_sum = np.zeros((topk, 2))
+    for start in range(0, number_of_queries, query_batch_size):
+        queries = slice(start, start + query_batch_size)
+        top_indices, _, _ = find_similar_by_color_histograms_batch(imgs_paths, imgs_color_hists, imgs_color_hists[queries], topk)
+
+        relevant = group_ids_dense[top_indices] == group_ids_dense[queries, np.newaxis]
+        tp = np.cumsum(relevant, axis=1)
+        rec = tp / gt_sizes[queries, np.newaxis]
+        prec = tp / sample_size[np.newaxis]
+
+        average_precision_sum += ((prec * relevant).sum(axis=1) / gt_sizes[queries]).sum()
+        ns_score_sum += tp[:, min(UKBENCH_GROUP_SIZE, topk) - 1].sum()
+        curve_sum += np.stack((rec, prec), axis=2).sum(axis=0)
+
+    report = {
+        'number_of_queries': int(number_of_queries),
+        'topk': int(topk),
+        'mAP': float(average_precision_sum / number_of_queries),
+        'ns_score': float(ns_score_sum / number_of_queries),
+        'mean_pr_curve': (curve_sum / number_of_queries).tolist(),
+        'seconds': time.perf_counter() - start_time,
+    }
+    return report
+
+
 if __name__ == "__main__":
     # run from project folder (Content_based_image_retrieval).
     # assumed that project folder contains folder imgs with test images in it.
     # construct PR-curve for 5 image queries
     # repeat pretty much process from query.py with tweak at the end
-    import os
     import cv2
+    import json
     import matplotlib.pyplot as plt  # as we need to plot PR-curves, and opencv is not even remotely good for plotting
-    from hist import calcColorHistsCV2, calcColorHistCV2
+    from hist import calcColorHistCV2
+    from index import update_color_hists_index
 
     imgs_folder = 'imgs'
+    index_path = 'imgs_color_hists'
     output_img_folder = 'report_imgs'
+    report_path = 'evaluation_report.json'
     histSize = 256
     ranges = [0, 256]
     query_imgs_paths = ['imgs/ukbench00004.jpg', 'imgs/ukbench00040.jpg', 'imgs/ukbench00060.jpg', 'imgs/ukbench00588.jpg', 'imgs/ukbench01562.jpg']
@@ -90,8 +172,9 @@ if __name__ == "__main__":
     # with smaller values we can plot part of PR-curve
     topk = 2000
 
+    # histograms are taken from on-disk index (memory-mapped), only new or changed images are decoded
     imgs_paths = [os.path.join(imgs_folder, path) for path in sorted(os.listdir(imgs_folder))]
-    imgs_color_hists = calcColorHistsCV2(imgs_paths, histSize=histSize, ranges=ranges)
+    imgs_paths, imgs_color_hists, _ = update_color_hists_index(index_path, imgs_paths, histSize=histSize, ranges=ranges, n_jobs=None)
 
     query_imgs = [cv2.imread(path, cv2.IMREAD_COLOR) for path in query_imgs_paths]
     query_color_hists = [calcColorHistCV2(img, mask=None, histSize=histSize, ranges=ranges) for img in query_imgs]
@@ -110,3 +193,9 @@ if __name__ == "__main__":
         # flush plot
         plt.clf()
         plt.cla()
+
+    # every image as a query, machine-readable report to track regressions
+    report = evaluate_all_queries(imgs_paths, imgs_color_hists, ukbench_group_ids(imgs_paths))
+    with open(report_path, 'w') as f:
+        json.dump(report, f)
+    print(f"queries: {report['number_of_queries']}, mAP: {report['mAP']:.4f}, N-S score: {report['ns_score']:.3f}, time: {report['seconds']:.2f}s")
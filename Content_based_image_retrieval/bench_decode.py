@@ -0,0 +1,47 @@
+import os
+import time
+
+from hist import calcColorHistsCV2, IMREAD_REDUCTIONS
+from PRcurve import evaluate_all_queries, ukbench_group_ids
+
+
+def benchmark_reductions(imgs_paths, histSize, ranges, reductions, n_jobs=1):
+    """Measure histogram ingestion time and retrieval quality (mAP, N-S score over all queries) at every decode reduction.
+
+    Histograms are normalized by number of pixels at every scale, so that they are comparable between scales.
+
+    Args:
+        imgs_paths: list of strings, ukbench images
+        histSize: int, number of bins
+        ranges: list of two numbers, smallest (inclusive) and largest (exclusive) values to consider
+        reductions: list of ints, keys of hist.IMREAD_REDUCTIONS, the first one is a baseline for speedup
+        n_jobs: int, number of decoding threads
+
+    Return:
+        results: list of dicts with 'reduction', 'seconds', 'speedup', 'mAP', 'ns_score'
+    """
+    group_ids = ukbench_group_ids(imgs_paths)
+
+    results = []
+    for reduction in reductions:
+        start = time.perf_counter()
+        color_hists = calcColorHistsCV2(imgs_paths, histSize=histSize, ranges=ranges, n_jobs=n_jobs, reduction=reduction, normalize=True)
+        seconds = time.perf_counter() - start
+
+        report = evaluate_all_queries(imgs_paths, color_hists, group_ids)
+        results.append({'reduction': reduction, 'seconds': seconds, 'speedup': results[0]['seconds'] / seconds if results else 1.,
+                        'mAP': report['mAP'], 'ns_score': report['ns_score']})
+    return results
+
+
+if __name__ == "__main__":
+    # run from project folder (Content_based_image_retrieval).
+    # assumed that project folder contains folder imgs with test images in it.
+    imgs_folder = 'imgs'
+    histSize = 256
+    ranges = [0, 256]
+
+    imgs_paths = [os.path.join(imgs_folder, path) for path in sorted(os.listdir(imgs_folder))]
+    for result in benchmark_reductions(imgs_paths, histSize, ranges, reductions=sorted(IMREAD_REDUCTIONS)):
+        print(f"reduction 1/{result['reduction']}: {result['seconds']:.2f}s ({result['speedup']:.1f}x), "
+              f"mAP {result['mAP']:.4f}, N-S score {result['ns_score']:.3f}")
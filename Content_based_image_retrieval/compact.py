@@ -0,0 +1,100 @@
+import numpy as np
+
+from L2 import colorHistsSquaredNormsL2
+
+
+# Compact storages of normalized color histograms (every channel sums up to 1), dict of numpy arrays:
+#   'float16': values float16 [number_of_images, histogram_length]                                   - 2x smaller than float32
+#   'uint8':   values uint8 [number_of_images, histogram_length], scales float32 [number_of_images]   - 4x smaller, bin = value / scale
+#   'sparse':  indptr int64 [number_of_images + 1], indices uint16 [nnz], values float16 [nnz]        - CSR of non-zero bins, 4 bytes per non-zero bin
+# Every storage also keeps squared_norms float64 [number_of_images] of decoded histograms, which distance kernels rely on.
+STORAGES = ['float16', 'uint8', 'sparse']
+
+
+def normalizeColorHists(color_hists, histSize):
+    """Normalize color histograms so that every channel sums up to 1 (comparable across image sizes, bounded by 1).
+
+    Args:
+        color_hists: numpy array float32, of shape [number_of_images, 3*histSize] or [3*histSize]
+        histSize: int, number of bins per channel
+
+    Return:
+        normalized_color_hists: numpy array float32, same shape as color_hists
+    """
+    color_hists = np.asarray(color_hists, dtype=np.float32)
+    channels = color_hists.reshape(color_hists.shape[:-1] + (3, histSize))
+    totals = channels.sum(axis=-1, keepdims=True)
+    normalized = channels / np.maximum(totals, 1)
+    return normalized.reshape(color_hists.shape)
+
+
+def compressColorHists(normalized_color_hists, storage):
+    """Convert normalized color histograms into one of compact storages.
+
+    Args:
+        normalized_color_hists: numpy array float32, output of normalizeColorHists, of shape [number_of_images, histogram_length]
+        storage: string, one of STORAGES
+
+    Return:
+        compact_hists: dict of numpy arrays, described at the top of the module
+    """
+    normalized_color_hists = np.asarray(normalized_color_hists, dtype=np.float32)
+
+    if storage == 'float16':
+        values = normalized_color_hists.astype(np.float16)
+        compact_hists = {'values': values}
+        decoded = values.astype(np.float32)
+    elif storage == 'uint8':
+        # per histogram scale, so that its largest bin uses the whole range of uint8 (empty histograms keep scale 1)
+        maxima = normalized_color_hists.max(axis=1)
+        scales = 255 / np.where(maxima > 0, maxima, 255)
+        values = np.round(normalized_color_hists * scales[:, np.newaxis]).astype(np.uint8)
+        compact_hists = {'values': values, 'scales': scales.astype(np.float32)}
+        decoded = values / compact_hists['scales'][:, np.newaxis]
+    elif storage == 'sparse':
+        values = normalized_color_hists.astype(np.float16)
+        rows, indices = np.nonzero(values)
+        indptr = np.zeros(values.shape[0] + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=values.shape[0]))
+        compact_hists = {'indptr': indptr, 'indices': indices.astype(np.uint16), 'values': values[rows, indices]}
+        decoded = values.astype(np.float32)
+    else:
+        raise ValueError(f"Unknown storage '{storage}', expected one of {STORAGES}")
+
+    compact_hists['storage'] = storage
+    compact_hists['squared_norms'] = colorHistsSquaredNormsL2(decoded.astype(np.float32))
+    return compact_hists
+
+
+def compactColorHistsNBytes(compact_hists):
+    """Memory taken by compact histograms (norms excluded, as they are the same 8 bytes per image for every storage)."""
+    return sum(value.nbytes for key, value in compact_hists.items() if key not in ['storage', 'squared_norms'])
+
+
+if __name__ == "__main__":
+    # run from project folder (Content_based_image_retrieval).
+    # assumed that project folder contains folder imgs with test images in it.
+    # compare memory and ranking of compact storages against float32 normalized histograms, every image as a query.
+    import os
+    from index import update_color_hists_index
+    from L2 import colorHistsPairwiseDistancesL2, compactColorHistsPairwiseDistancesL2
+
+    imgs_folder = 'imgs'
+    index_path = 'imgs_color_hists'
+    histSize = 256
+    ranges = [0, 256]
+    topk = 10
+
+    imgs_paths = [os.path.join(imgs_folder, path) for path in sorted(os.listdir(imgs_folder))]
+    imgs_paths, imgs_color_hists, _ = update_color_hists_index(index_path, imgs_paths, histSize=histSize, ranges=ranges, n_jobs=None)
+    normalized_color_hists = normalizeColorHists(imgs_color_hists, histSize)
+
+    float32_top = np.argsort(colorHistsPairwiseDistancesL2(normalized_color_hists, normalized_color_hists), axis=1, kind='stable')[:, :topk]
+    print(f"float32: {normalized_color_hists.nbytes / 2**20:.2f} MiB")
+
+    for storage in STORAGES:
+        compact_hists = compressColorHists(normalized_color_hists, storage)
+        compact_top = np.argsort(compactColorHistsPairwiseDistancesL2(compact_hists, normalized_color_hists), axis=1, kind='stable')[:, :topk]
+        overlap = np.mean([len(np.intersect1d(a, b)) / topk for a, b in zip(compact_top, float32_top)])
+        print(f"{storage}: {compactColorHistsNBytes(compact_hists) / 2**20:.2f} MiB, "
+              f"{normalized_color_hists.nbytes / compactColorHistsNBytes(compact_hists):.1f}x smaller, top{topk} overlap with float32 {overlap:.3f}")
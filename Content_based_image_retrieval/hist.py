@@ -1,5 +1,10 @@
 import cv2
 import numpy as np
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+# decode flags per downscale factor, reduced JPEG decoding skips most of inverse DCT work
+IMREAD_REDUCTIONS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
 
 
 # own implementation of histogram
@@ -10,7 +15,7 @@ def calcHist(img, channel, mask, histSize, ranges):
     Args:
         img: numpy array of numbers, assumed to be representation of an image, where last dimension is channels
         channel: int, which channel of the image to consider
-        mask: numpy array of bool values, which spatial part of the image to consider. If None - consider whole image
+        mask: numpy array of bool or uint8 values (nonzero - selected), which spatial part of the image to consider. If None - consider whole image
         histSize: int, number of bins
         ranges: list of two numbers, smallest (inclusive) and largest (exclusive) values to consider
 
@@ -22,8 +27,9 @@ def calcHist(img, channel, mask, histSize, ranges):
     bin_width = (right_boundary - left_boundary) / histSize
 
     data = img[..., channel]
-    if mask:
-        data = data[mask]
+    if mask is not None:
+        # same semantics as opencv: any nonzero value selects pixel (mask can be bool or uint8)
+        data = data[mask != 0]
 
     # inclusive left, exclusive right
     data = data[np.logical_and(left_boundary <= data, data < right_boundary)].reshape(-1)
@@ -41,8 +47,77 @@ def calcHist(img, channel, mask, histSize, ranges):
     return bin_counts, intervals
 
 
+def _binLookupTable8U(histSize, ranges):
+    """Bin number for every possible uint8 value, -1 for values outside of ranges (same arithmetic as opencv uses for 8-bit images).
+
+    Opencv takes ranges as float32, and computes bins in double precision from those rounded boundaries: floor(v*scale + offset),
+    where scale = histSize/(high - low), offset = -scale*low. Same steps here, so that bins match cv2.calcHist for non-integer ranges too.
+    """
+    left_boundary, right_boundary = (float(boundary) for boundary in np.asarray(ranges, dtype=np.float32))
+    values = np.arange(256, dtype=np.float64)
+
+    scale = histSize / (right_boundary - left_boundary)
+    offset = -scale * left_boundary
+    bin_numbers = np.clip(np.floor(values * scale + offset), 0, histSize - 1).astype(np.int32)
+
+    # inclusive left, exclusive right
+    inside = np.logical_and(left_boundary <= values, values < right_boundary)
+    return np.where(inside, bin_numbers, -1)
+
+
+def calcColorHistFused(img, mask, histSize, ranges):
+    """Calculate histograms of all three channels of uint8 image (or batch of images) in a single pass, and concatenate them together.
+
+    Every pixel value is shifted by offset of its channel (and image in batch), so that one np.bincount over the raw buffer
+    counts occurrences of every (image, channel, value) - no range filtering, no division, no sorting.
+    Counts of 256 values of every channel are then folded into histSize bins through a small lookup table.
+    Output matches calcColorHistCV2 exactly.
+
+    Args:
+        img: numpy array uint8, BGR image of shape [height, width, 3], or batch of same-sized images of shape [number_of_images, height, width, 3]
+        mask: numpy array of bool or uint8 values (nonzero - selected), of shape [height, width] (shared by the whole batch),
+            or [number_of_images, height, width] for a batch. If None - consider whole image
+        histSize: int, number of bins
+        ranges: list of two numbers, smallest (inclusive) and largest (exclusive) values to consider
+
+    Return:
+        color_hists: numpy array float32, of shape [3*histSize] for single image or [number_of_images, 3*histSize] for batch
+    """
+    single_image = img.ndim == 3
+    if single_image:
+        img = img[np.newaxis]
+    number_of_images, height, width, channels = img.shape
+
+    # offset of (image, channel) pair for every element of an image row, rows are long, so that addition below is a long contiguous loop
+    channel_offsets = np.tile(256 * np.arange(channels, dtype=np.intp), width)
+    image_offsets = 256 * channels * np.arange(number_of_images, dtype=np.intp)
+    offsets = image_offsets[:, np.newaxis, np.newaxis] + channel_offsets[np.newaxis, np.newaxis]
+
+    positions = img.reshape(number_of_images, height, width * channels) + offsets
+    if mask is not None:
+        mask = np.broadcast_to(mask != 0, (number_of_images, height, width))
+        positions = positions.reshape(number_of_images, height, width, channels)[mask]
+
+    value_counts = np.bincount(positions.reshape(-1), minlength=number_of_images * channels * 256).reshape(number_of_images, channels * 256)
+
+    # fold value counts into bins, values outside of ranges land in the extra last bin, which is dropped
+    bin_numbers = _binLookupTable8U(histSize, ranges)
+    bin_positions = np.where(bin_numbers >= 0, bin_numbers[np.newaxis] + histSize * np.arange(channels)[:, np.newaxis], channels * histSize).reshape(-1)
+    bin_counts = np.zeros((number_of_images, channels * histSize + 1), dtype=np.int64)
+    np.add.at(bin_counts, (slice(None), bin_positions), value_counts)
+    color_hists = bin_counts[:, :-1].astype(np.float32)  # type can be int (makes more sense, but opencv outputs float32)
+
+    if single_image:
+        return color_hists[0]
+    return color_hists
+
+
 def calcColorHist(img, mask, histSize, ranges):
     """Same as calcHist, but go over all color channels, assuming BGR image, and concatenate histograms together."""
+    # uint8 images (which is what cv2.imread gives) go through fused single pass kernel, everything else - channel by channel
+    if img.dtype == np.uint8:
+        return calcColorHistFused(img, mask=mask, histSize=histSize, ranges=ranges)
+
     hist_blue, _ = calcHist(img, channel=0, mask=mask, histSize=histSize, ranges=ranges)
     hist_green, _ = calcHist(img, channel=1, mask=mask, histSize=histSize, ranges=ranges)
     hist_red, _ = calcHist(img, channel=2, mask=mask, histSize=histSize, ranges=ranges)
@@ -64,38 +139,118 @@ def calcColorHistCV2(img, mask, histSize, ranges):
     return hist_color
 
 
+def _calcColorHistsInto(color_hists, imgs_paths, calc_color_hist, histSize, ranges, executor, reduction=1, normalize=False):
+    """Read images and write their color histograms row by row into preallocated color_hists (in input order)."""
+    imread_flag = IMREAD_REDUCTIONS[reduction]
+
+    def calc_row(row_and_path):
+        row, path = row_and_path
+        # cv2.imread and cv2.calcHist release the GIL, so threads do run in parallel here
+        img = cv2.imread(path, imread_flag)
+        color_hists[row] = calc_color_hist(img, mask=None, histSize=histSize, ranges=ranges)
+        if normalize:
+            color_hists[row] /= img.shape[0] * img.shape[1]
+
+    if executor is None:
+        for row_and_path in enumerate(imgs_paths):
+            calc_row(row_and_path)
+    else:
+        # consume results, so that exceptions from workers are not silently lost
+        for _ in executor.map(calc_row, enumerate(imgs_paths)):
+            pass
+
+
+def _calcColorHists(imgs_paths, calc_color_hist, histSize, ranges, n_jobs, out, reduction, normalize):
+    if out is None:
+        out = np.empty((len(imgs_paths), 3*histSize), dtype=np.float32)
+
+    if n_jobs == 1:
+        _calcColorHistsInto(out, imgs_paths, calc_color_hist, histSize, ranges, executor=None, reduction=reduction, normalize=normalize)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            _calcColorHistsInto(out, imgs_paths, calc_color_hist, histSize, ranges, executor=executor, reduction=reduction, normalize=normalize)
+    return out
+
+
 # Dropping mask parameter in this wrapper, as not going to use any.
 # Logically it should be separate mask for each image, and generating random ones is pointless.
-def calcColorHists(imgs_paths, histSize, ranges):
+def calcColorHists(imgs_paths, histSize, ranges, n_jobs=1, out=None, reduction=1, normalize=False):
     """Calculate color histograms for all images provided with their paths.
 
     Args:
         imgs_paths: list of strings, with paths to images
         histSize: int, number of bins
         ranges: list of two numbers, smallest (inclusive) and largest (exclusive) values to consider
+        n_jobs: int, number of worker threads, 1 - calculate in the calling thread, None - as many as CPU cores
+        out: numpy array float32 (can be memory-mapped), of shape [number_of_images, 3*histSize] to write to. If None - allocate new
+        reduction: int, one of IMREAD_REDUCTIONS keys, decode images downscaled by this factor (JPEG decoder skips most of the work)
+        normalize: bool, divide histograms by number of pixels, so that histograms of different sizes (or reductions) are comparable
 
     Return:
         color_hists: numpy array float32, of shape [number_of_images, 3*histSize]
     """
     # paths to images is a more flexible way than either path to the folder (how do we subset images?) and way less memory bounded than image arrays
-    color_hists = np.stack([calcColorHist(cv2.imread(path, cv2.IMREAD_COLOR), mask=None, histSize=histSize, ranges=ranges) for path in imgs_paths])
-    return color_hists
+    return _calcColorHists(imgs_paths, calcColorHist, histSize, ranges, n_jobs=n_jobs, out=out, reduction=reduction, normalize=normalize)
 
 
 # same thing with mask parameter for opencv based implementation.
-def calcColorHistsCV2(imgs_paths, histSize, ranges):
+def calcColorHistsCV2(imgs_paths, histSize, ranges, n_jobs=1, out=None, reduction=1, normalize=False):
     """Calculate color histograms for all images provided with their paths.
 
     Args:
         imgs_paths: list of strings, with paths to images
         histSize: int, number of bins
         ranges: list of two numbers, smallest (inclusive) and largest (exclusive) values to consider
+        n_jobs: int, number of worker threads, 1 - calculate in the calling thread, None - as many as CPU cores
+        out: numpy array float32 (can be memory-mapped), of shape [number_of_images, 3*histSize] to write to. If None - allocate new
+        reduction: int, one of IMREAD_REDUCTIONS keys, decode images downscaled by this factor (JPEG decoder skips most of the work)
+        normalize: bool, divide histograms by number of pixels, so that histograms of different sizes (or reductions) are comparable
 
     Return:
         color_hists: numpy array float32, of shape [number_of_images, 3*histSize]
     """
-    color_hists = np.stack([calcColorHistCV2(cv2.imread(path, cv2.IMREAD_COLOR), mask=None, histSize=histSize, ranges=ranges) for path in imgs_paths])
-    return color_hists
+    return _calcColorHists(imgs_paths, calcColorHistCV2, histSize, ranges, n_jobs=n_jobs, out=out, reduction=reduction, normalize=normalize)
+
+
+def iterColorHistsCV2(imgs_paths, histSize, ranges, chunk_size=1024, n_jobs=1, progress=None, reduction=1, normalize=False):
+    """Lazily calculate color histograms chunk by chunk, so that memory stays bounded by chunk_size regardless of number of images.
+
+    Args:
+        imgs_paths: iterable of strings, with paths to images (can be a generator, e.g. over a directory listing)
+        histSize: int, number of bins
+        ranges: list of two numbers, smallest (inclusive) and largest (exclusive) values to consider
+        chunk_size: int, number of images per yielded chunk
+        n_jobs: int, number of worker threads, 1 - calculate in the calling thread, None - as many as CPU cores
+        progress: callable or None, called after every chunk as progress(number_of_processed_images, total), total is None if unknown
+        reduction: int, one of IMREAD_REDUCTIONS keys, decode images downscaled by this factor
+        normalize: bool, divide histograms by number of pixels
+
+    Return (yield):
+        start: int, index of the first image of the chunk in imgs_paths
+        color_hists: numpy array float32, of shape [chunk_length, 3*histSize]
+    """
+    total = len(imgs_paths) if hasattr(imgs_paths, '__len__') else None
+    imgs_paths = iter(imgs_paths)
+
+    executor = None if n_jobs == 1 else ThreadPoolExecutor(max_workers=n_jobs)
+    try:
+        start = 0
+        while True:
+            chunk_paths = list(islice(imgs_paths, chunk_size))
+            if not chunk_paths:
+                break
+
+            color_hists = np.empty((len(chunk_paths), 3*histSize), dtype=np.float32)
+            _calcColorHistsInto(color_hists, chunk_paths, calcColorHistCV2, histSize, ranges, executor=executor, reduction=reduction, normalize=normalize)
+
+            if progress is not None:
+                progress(start + len(chunk_paths), total)
+
+            yield start, color_hists
+            start += len(chunk_paths)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
 
 if __name__ == "__main__":
@@ -111,3 +266,8 @@ if __name__ == "__main__":
     color_hists_cv2 = calcColorHistsCV2(imgs_paths, histSize=histSize, ranges=ranges)
     print("Do color histograms calculated with own implementation and opencv-based implementation match for all images?\n", np.all(color_hists == color_hists_cv2))
     # if you see True printed, then everything works fine
+
+    color_hists_parallel = calcColorHistsCV2(imgs_paths, histSize=histSize, ranges=ranges, n_jobs=None)
+    color_hists_streamed = np.concatenate([chunk for _, chunk in iterColorHistsCV2(imgs_paths, histSize=histSize, ranges=ranges, chunk_size=256, n_jobs=None)])
+    print("Do parallel and streamed color histograms match sequential ones?\n", np.all(color_hists_parallel == color_hists_cv2) and np.all(color_hists_streamed == color_hists_cv2))
+    # if you see True printed, then everything works fine
@@ -0,0 +1,139 @@
+import os
+import json
+import numpy as np
+
+from hist import iterColorHistsCV2
+
+
+# on-disk index of color histograms consists of two files sharing the same base path:
+#   <index_path>.json       - manifest: histogram parameters, generation, and path/mtime/size per row of the matrix
+#   <index_path>.<gen>.npy  - float32 matrix of shape [number_of_images, 3*histSize], opened memory-mapped (no copy)
+# manifest is the single source of truth: it is swapped atomically and names the matrix of its generation,
+# so that neither readers nor an interrupted update can pair rows with wrong paths.
+MATRIX_SUFFIX = '.npy'
+MANIFEST_SUFFIX = '.json'
+
+
+def _matrix_path(index_path, generation):
+    return f'{index_path}.{generation}{MATRIX_SUFFIX}'
+
+
+def _file_signature(path):
+    """Cheap file identity used to detect changes without decoding: modification time (ns) and size (bytes)."""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_color_hists_index(index_path):
+    """Open existing on-disk color histograms index.
+
+    Args:
+        index_path: string, path to the index without suffix
+
+    Return:
+        imgs_paths: list of strings, paths to images in order of matrix rows
+        imgs_color_hists: numpy memmap float32 (read-only), of shape [number_of_images, 3*histSize]
+        manifest: dict, histSize, ranges, generation and per image entries (path, mtime, size)
+    """
+    with open(index_path + MANIFEST_SUFFIX, 'r') as f:
+        manifest = json.load(f)
+
+    imgs_paths = [entry['path'] for entry in manifest['entries']]
+    if imgs_paths:
+        imgs_color_hists = np.load(_matrix_path(index_path, manifest['generation']), mmap_mode='r')
+    else:
+        # numpy refuses to memory-map empty files, nothing to share anyway
+        imgs_color_hists = np.zeros((0, 3*manifest['histSize']), dtype=np.float32)
+
+    return imgs_paths, imgs_color_hists, manifest
+
+
+def update_color_hists_index(index_path, imgs_paths, histSize, ranges, n_jobs=1, chunk_size=1024):
+    """Create or incrementally update on-disk color histograms index, so that it matches given list of images.
+
+    Histograms are recalculated only for images that are new or changed (by mtime or size) since the last update,
+    rows of images that are no longer in the list are dropped, the rest is copied from the previous index as is.
+    If histogram parameters differ from the ones stored in the index, it is rebuilt from scratch.
+
+    Args:
+        index_path: string, path to the index without suffix
+        imgs_paths: list of strings, with paths to images, define order of rows in the index
+        histSize: int, number of bins
+        ranges: list of two numbers, smallest (inclusive) and largest (exclusive) values to consider
+        n_jobs: int, number of worker threads to calculate histograms of new and changed images with (see hist.iterColorHistsCV2)
+        chunk_size: int, number of new and changed histograms calculated at once before being written to the index
+
+    Return:
+        imgs_paths: list of strings, paths to images in order of matrix rows
+        imgs_color_hists: numpy memmap float32 (read-only), of shape [number_of_images, 3*histSize]
+        manifest: dict, histSize, ranges, generation and per image entries (path, mtime, size)
+    """
+    entries = []
+    for path in imgs_paths:
+        mtime, size = _file_signature(path)
+        entries.append({'path': path, 'mtime': mtime, 'size': size})
+
+    # row of the previous index for every (path, mtime, size) that is still valid
+    old_rows = {}
+    old_color_hists = None
+    old_generation = None
+    if os.path.exists(index_path + MANIFEST_SUFFIX):
+        old_imgs_paths, old_color_hists, old_manifest = load_color_hists_index(index_path)
+        old_generation = old_manifest['generation']
+        if old_manifest['histSize'] == histSize and list(old_manifest['ranges']) == list(ranges):
+            # nothing added, changed, removed or reordered: index is up to date, no need to write a new generation
+            if old_manifest['entries'] == entries:
+                return old_imgs_paths, old_color_hists, old_manifest
+            old_rows = {(entry['path'], entry['mtime'], entry['size']): row for row, entry in enumerate(old_manifest['entries'])}
+
+    generation = 0 if old_generation is None else old_generation + 1
+    manifest = {'histSize': histSize, 'ranges': list(ranges), 'generation': generation, 'entries': entries}
+
+    # write new generation next to the old one, so that readers never see half-written index
+    matrix_path = _matrix_path(index_path, generation)
+    tmp_manifest_path = index_path + '.tmp' + MANIFEST_SUFFIX
+
+    color_hists = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32, shape=(len(entries), 3*histSize))
+    changed_rows = []
+    for i, entry in enumerate(entries):
+        old_row = old_rows.get((entry['path'], entry['mtime'], entry['size']))
+        if old_row is not None:
+            color_hists[i] = old_color_hists[old_row]
+        else:
+            changed_rows.append(i)
+
+    # new and changed histograms are streamed chunk by chunk into the memory map, so memory stays bounded by chunk_size
+    changed_paths = [entries[i]['path'] for i in changed_rows]
+    for start, chunk in iterColorHistsCV2(changed_paths, histSize=histSize, ranges=ranges, chunk_size=chunk_size, n_jobs=n_jobs):
+        color_hists[changed_rows[start:start + len(chunk)]] = chunk
+    color_hists.flush()
+    del color_hists, old_color_hists
+
+    with open(tmp_manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+    os.replace(tmp_manifest_path, index_path + MANIFEST_SUFFIX)
+
+    # previous generation is unreachable now (already opened memory maps keep working on posix)
+    if old_generation is not None and os.path.exists(_matrix_path(index_path, old_generation)):
+        os.remove(_matrix_path(index_path, old_generation))
+
+    return load_color_hists_index(index_path)
+
+
+if __name__ == "__main__":
+    # run from project folder (Content_based_image_retrieval).
+    # assumed that project folder contains folder imgs with test images in it.
+    # build (or refresh) index and check it against histograms calculated from scratch.
+    from hist import calcColorHistsCV2
+
+    imgs_folder = 'imgs'
+    index_path = 'imgs_color_hists'
+    histSize = 256
+    ranges = [0, 256]
+
+    imgs_paths = [os.path.join(imgs_folder, path) for path in sorted(os.listdir(imgs_folder))]
+    index_imgs_paths, index_color_hists, _ = update_color_hists_index(index_path, imgs_paths, histSize=histSize, ranges=ranges, n_jobs=None)
+    color_hists_cv2 = calcColorHistsCV2(imgs_paths, histSize=histSize, ranges=ranges)
+    print("Does index match color histograms calculated from scratch?\n", index_imgs_paths == imgs_paths and np.all(index_color_hists == color_hists_cv2))
+    # if you see True printed, then everything works fine
@@ -0,0 +1,215 @@
+import cv2
+import numpy as np
+
+from L2 import colorHistsPairwiseDistancesL2, colorHistsSquaredNormsL2
+from query import REFINE_BUDGET
+
+
+# Approximate nearest neighbours search over color histograms: inverted file (IVF) with k-means coarse quantizer.
+# Dataset is split into n_lists clusters, each query scans only vectors of nprobe clusters with closest centroids.
+# Optionally vectors are reduced with PCA beforehand, which makes both lists and distance calculations cheaper.
+# Search goes list by list: all queries probing a list get their distances to it from a single matrix multiplication.
+#
+# Index is a dict of numpy arrays (so that it saves and loads as is with np.savez / np.load):
+#   centroids:      float32 [n_lists, dim], k-means centers in (reduced) vector space
+#   list_offsets:   int64 [n_lists + 1], list i occupies list_rows[list_offsets[i]:list_offsets[i+1]]
+#   list_rows:      int64 [number_of_images], dataset rows grouped by list
+#   list_vectors:   float32 [number_of_images, dim], (reduced) vectors in the same order as list_rows
+#   list_squared_norms: float64 [number_of_images], squared norms of list_vectors (L2.colorHistsSquaredNormsL2)
+#   pca_mean:       float32 [1, histogram_length], empty [0, histogram_length] if no PCA
+#   pca_components: float32 [dim, histogram_length], empty [0, histogram_length] if no PCA
+
+
+def _reduce(ivf_index, color_hists):
+    """Project color histograms into vector space of the index (identity if index built without PCA)."""
+    color_hists = np.asarray(color_hists, dtype=np.float32)
+    if ivf_index['pca_components'].shape[0] == 0:
+        return color_hists
+    return cv2.PCAProject(color_hists, ivf_index['pca_mean'], ivf_index['pca_components'])
+
+
+def build_ivf_index(imgs_color_hists, n_lists, pca_dim=None, stop_criteria=None, seed=0):
+    """Build inverted file index with k-means coarse quantizer over color histograms.
+
+    Args:
+        imgs_color_hists: numpy array float32, of shape [number_of_images, histogram_length], can be memory-mapped
+        n_lists: int, number of clusters (inverted lists), sqrt(number_of_images) is a reasonable start
+        pca_dim: int, number of principal components to keep. If None - keep vectors as is
+        stop_criteria: dict, where 'max_iter' - maximum number of k-means iterations, 'epsilon' - min centers shift to continue. If None - 20 and 1e-3
+        seed: int, seed of opencv random generator (k-means++ initialization)
+
+    Return:
+        ivf_index: dict of numpy arrays, described at the top of the module
+    """
+    if stop_criteria is None:
+        stop_criteria = {'max_iter': 20, 'epsilon': 1e-3}
+
+    imgs_color_hists = np.ascontiguousarray(imgs_color_hists, dtype=np.float32)
+    histogram_length = imgs_color_hists.shape[1]
+
+    if pca_dim is None:
+        pca_mean = np.zeros((0, histogram_length), dtype=np.float32)
+        pca_components = np.zeros((0, histogram_length), dtype=np.float32)
+    else:
+        pca_mean, pca_components = cv2.PCACompute(imgs_color_hists, mean=None, maxComponents=pca_dim)
+
+    ivf_index = {'pca_mean': pca_mean.astype(np.float32), 'pca_components': pca_components.astype(np.float32)}
+    vectors = _reduce(ivf_index, imgs_color_hists)
+
+    cv2.setRNGSeed(seed)
+    term_crit = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, stop_criteria['max_iter'], stop_criteria['epsilon'])
+    _, labels, centroids = cv2.kmeans(vectors, n_lists, None, term_crit, 1, cv2.KMEANS_PP_CENTERS)
+    labels = labels.reshape(-1)
+
+    # group rows by list, stable, so that rows stay in dataset order within a list
+    list_rows = np.argsort(labels, kind='stable')
+    list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    list_offsets[1:] = np.cumsum(np.bincount(labels, minlength=n_lists))
+
+    ivf_index['centroids'] = centroids.astype(np.float32)
+    ivf_index['list_offsets'] = list_offsets
+    ivf_index['list_rows'] = list_rows.astype(np.int64)
+    ivf_index['list_vectors'] = vectors[list_rows]
+    ivf_index['list_squared_norms'] = colorHistsSquaredNormsL2(ivf_index['list_vectors'])
+    return ivf_index
+
+
+def save_ivf_index(path, ivf_index):
+    """Save index to a single .npz file (uncompressed, so that it loads fast)."""
+    np.savez(path, **ivf_index)
+
+
+def load_ivf_index(path):
+    """Load index saved with save_ivf_index."""
+    with np.load(path) as data:
+        ivf_index = {key: data[key] for key in data.files}
+    if 'list_squared_norms' not in ivf_index:
+        # saved before norms were part of the index
+        ivf_index['list_squared_norms'] = colorHistsSquaredNormsL2(ivf_index['list_vectors'])
+    return ivf_index
+
+
+def search_ivf_index(ivf_index, query_color_hists, topk, nprobe, imgs_color_hists=None):
+    """Retrieve approximately closest images for each query, scanning only nprobe inverted lists with centroids closest to the query.
+
+    Lists are scanned one by one, each by all queries probing it at once: list vectors are a contiguous slice of the index
+    (no gathering), their stored squared norms complete the expansion of colorHistsPairwiseDistancesL2.
+    Every list contributes its topk closest vectors per query, the best topk of them (over nprobe lists) are the result.
+
+    Args:
+        ivf_index: dict of numpy arrays, output of build_ivf_index or load_ivf_index
+        query_color_hists: numpy array float32, of shape [number_of_queries, histogram_length]
+        topk: int
+        nprobe: int, number of lists to scan per query, higher - better recall, slower search (n_lists - same as exact search)
+        imgs_color_hists: numpy array float32, of shape [number_of_images, histogram_length], dataset the index was built from, can be memory-mapped.
+                          If given - all candidates (topk per probed list) are re-ranked by exact distances in the original space,
+                          which undoes the approximation of PCA. If None - ranked by distances in vector space of the index
+
+    Return:
+        top_indices: numpy array int64, of shape [number_of_queries, topk], dataset rows ordered by ascending distance, -1 where fewer candidates than topk
+        top_distances: numpy array float32, of shape [number_of_queries, topk], distances (in the original space if imgs_color_hists is given,
+                       in vector space of the index otherwise), inf where no candidate
+    """
+    query_color_hists = np.atleast_2d(query_color_hists)
+    queries = _reduce(ivf_index, query_color_hists)
+    centroids = ivf_index['centroids']
+    list_offsets = ivf_index['list_offsets']
+    number_of_queries = queries.shape[0]
+    nprobe = min(nprobe, centroids.shape[0])
+
+    # closest lists per query
+    centroid_distances = colorHistsPairwiseDistancesL2(centroids, queries)
+    probed_lists = np.argpartition(centroid_distances, nprobe - 1, axis=1)[:, :nprobe]
+
+    # (query, probe) pairs grouped by list, so that queries probing the same list are adjacent
+    probes_order = np.argsort(probed_lists.reshape(-1), kind='stable')
+    lists, probes_offsets = np.unique(probed_lists.reshape(-1)[probes_order], return_index=True)
+    probes_offsets = np.append(probes_offsets, len(probes_order))
+
+    # candidates of every probe land in their own topk slots, unused slots stay -1/inf
+    candidates = np.full((number_of_queries, nprobe * topk), -1, dtype=np.int64)
+    candidates_distances = np.full((number_of_queries, nprobe * topk), np.inf, dtype=np.float32)
+    for i, j in enumerate(lists):
+        start, end = list_offsets[j], list_offsets[j + 1]
+        if start == end:
+            continue
+        probes = probes_order[probes_offsets[i]:probes_offsets[i + 1]]
+        query_rows, probe_slots = np.divmod(probes, nprobe)
+
+        distances = colorHistsPairwiseDistancesL2(ivf_index['list_vectors'][start:end], queries[query_rows], ivf_index['list_squared_norms'][start:end])
+
+        k = min(topk, end - start)
+        if k < end - start:
+            nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            nearest = np.broadcast_to(np.arange(end - start), distances.shape)
+        slots = probe_slots[:, np.newaxis] * topk + np.arange(k)
+        candidates[query_rows[:, np.newaxis], slots] = ivf_index['list_rows'][start + nearest]
+        candidates_distances[query_rows[:, np.newaxis], slots] = np.take_along_axis(distances, nearest, axis=1)
+
+    if imgs_color_hists is not None:
+        # exact distances for candidates, few queries at a time, so that gathered histograms fit into REFINE_BUDGET
+        query_color_hists = np.asarray(query_color_hists, dtype=np.float32)
+        refine_batch_size = max(1, REFINE_BUDGET // (nprobe * topk * query_color_hists.shape[1]))
+        for start in range(0, number_of_queries, refine_batch_size):
+            rows = slice(start, start + refine_batch_size)
+            found = candidates[rows] >= 0
+            gathered = imgs_color_hists[np.maximum(candidates[rows], 0)]
+            exact_distances = np.sqrt(np.square(gathered - query_color_hists[rows, np.newaxis]).sum(axis=2))
+            candidates_distances[rows] = np.where(found, exact_distances, np.inf)
+
+    # best topk over all probes, ties resolved by dataset row, so that result does not depend on order of probes
+    order = np.lexsort((candidates, candidates_distances), axis=1)[:, :topk]
+    top_indices = np.take_along_axis(candidates, order, axis=1)
+    top_distances = np.take_along_axis(candidates_distances, order, axis=1)
+    return top_indices, top_distances
+
+
+if __name__ == "__main__":
+    # run from project folder (Content_based_image_retrieval).
+    # assumed that project folder contains folder imgs with test images in it.
+    # build IVF index, save/load it, measure recall@k and speed against exact search for every image as a query.
+    import os
+    import time
+    from index import update_color_hists_index
+    from query import find_similar_by_color_histograms_batch
+    from PRcurve import ukbench_group_ids, UKBENCH_GROUP_SIZE
+
+    imgs_folder = 'imgs'
+    index_path = 'imgs_color_hists'
+    ivf_index_path = 'imgs_color_hists_ivf.npz'
+    histSize = 256
+    ranges = [0, 256]
+    topk = UKBENCH_GROUP_SIZE
+    pca_dim = 64
+
+    imgs_paths = [os.path.join(imgs_folder, path) for path in sorted(os.listdir(imgs_folder))]
+    imgs_paths, imgs_color_hists, _ = update_color_hists_index(index_path, imgs_paths, histSize=histSize, ranges=ranges, n_jobs=None)
+    group_ids = ukbench_group_ids(imgs_paths)
+    n_lists = int(np.sqrt(len(imgs_paths)))
+
+    start = time.perf_counter()
+    exact_indices, _, _ = find_similar_by_color_histograms_batch(imgs_paths, imgs_color_hists, imgs_color_hists, topk)
+    exact_time = time.perf_counter() - start
+
+    # recall@k against ground truth: fraction of group members among topk, and against exact search: fraction of exact topk found
+    def recall_ground_truth(indices):
+        hits = (indices >= 0) & (group_ids[np.maximum(indices, 0)] == group_ids[:, np.newaxis])
+        return hits.sum(axis=1).mean() / min(topk, UKBENCH_GROUP_SIZE)
+
+    def recall_exact(indices):
+        return np.mean([len(np.intersect1d(a, e)) / topk for a, e in zip(indices, exact_indices)])
+
+    print(f"exact: recall@{topk} {recall_ground_truth(exact_indices):.3f}, {exact_time:.3f}s")
+
+    for reduction in [None, pca_dim]:
+        save_ivf_index(ivf_index_path, build_ivf_index(imgs_color_hists, n_lists=n_lists, pca_dim=reduction))
+        ivf_index = load_ivf_index(ivf_index_path)
+        for nprobe in [1, 2, 4, 8, 16]:
+            # re-ranking in the original space only changes anything for reduced vectors
+            for rerank in [False, True] if reduction else [False]:
+                start = time.perf_counter()
+                ivf_indices, _ = search_ivf_index(ivf_index, imgs_color_hists, topk, nprobe=nprobe, imgs_color_hists=imgs_color_hists if rerank else None)
+                ivf_time = time.perf_counter() - start
+                print(f"ivf (n_lists={n_lists}, pca_dim={reduction}, nprobe={nprobe}, rerank={rerank}): recall@{topk} {recall_ground_truth(ivf_indices):.3f}, "
+                      f"recall of exact top{topk} {recall_exact(ivf_indices):.3f}, {ivf_time:.3f}s")
@@ -1,5 +1,8 @@
 import numpy as np
-from L2 import colorHistsMultipleDistancesL2
+from L2 import colorHistsTopkL2, colorHistsPairwiseDistancesL2, colorHistsSquaredNormsL2
+
+REFINE_BUDGET = 2**24  # max number of float32 elements in temporary of gathered candidate histograms during exact re-ranking
+DISTANCES_BUDGET = 2**22  # max number of float64 elements in [queries, number_of_images] temporary of distances (32 MiB)
 
 
 def find_similar_by_color_histograms(imgs_paths, imgs_color_hists, query_color_hist, topk):
@@ -7,7 +10,7 @@ def find_similar_by_color_histograms(imgs_paths, imgs_color_hists, query_color_h
 
     Args:
         imgs_paths: list of strings
-        imgs_color_hists: numpy array float32
+        imgs_color_hists: numpy array float32, can be memory-mapped (e.g. from index.load_color_hists_index), it is never copied
         query_color_hist: numpy array float32
         topk: int
 
@@ -17,26 +20,91 @@ def find_similar_by_color_histograms(imgs_paths, imgs_color_hists, query_color_h
     if isinstance(imgs_paths, list):
         imgs_paths = np.array(imgs_paths)
 
-    distances = colorHistsMultipleDistancesL2(imgs_color_hists, query_color_hist)
-
-    # get order of sorting distances in ascending order
-    order = np.argsort(distances)
-
-    # take indices corresponding to first topk closest images
-    order = order[:topk]
+    # indices of first topk closest images in ascending order of distances, streamed over dataset chunk by chunk
+    order, _ = colorHistsTopkL2(imgs_color_hists, query_color_hist, topk)
 
     # retrieve closest images
     top_imgs_paths = imgs_paths[order]
     return top_imgs_paths
 
 
+def find_similar_by_color_histograms_batch(imgs_paths, imgs_color_hists, query_color_hists, topk, imgs_squared_norms=None, query_batch_size=None):
+    """Retrieve from dataset images closest to each of given queries based on L2 distance between color histograms.
+
+    Distances for a batch of queries come from a single matrix multiplication (see L2.colorHistsPairwiseDistancesL2),
+    candidates are selected with np.argpartition instead of full sort, and only they are sorted.
+    As float32 dot products are not exact, 2*topk candidates are re-ranked by exact distances, so that output agrees with find_similar_by_color_histograms.
+
+    Args:
+        imgs_paths: list of strings
+        imgs_color_hists: numpy array float32, of shape [number_of_images, histogram_length], can be memory-mapped
+        query_color_hists: numpy array float32, of shape [number_of_queries, histogram_length]
+        topk: int
+        imgs_squared_norms: numpy array float64, output of L2.colorHistsSquaredNormsL2 for imgs_color_hists. If None - calculate
+        query_batch_size: int, number of queries to calculate distances for at once, bounds [query_batch_size, number_of_images] temporary.
+                          If None - as many as fit into DISTANCES_BUDGET, so that the temporary does not grow with the dataset
+
+    Return:
+        top_indices: numpy array int64, of shape [number_of_queries, topk], rows of imgs_color_hists ordered by ascending distance
+        top_distances: numpy array float32, of shape [number_of_queries, topk]
+        top_imgs_paths: numpy array of strings, of shape [number_of_queries, topk]
+    """
+    if topk < 1:
+        raise ValueError(f"topk should be at least 1, got {topk}")
+
+    imgs_paths = np.asarray(imgs_paths)
+    query_color_hists = np.atleast_2d(query_color_hists)
+    if imgs_squared_norms is None:
+        imgs_squared_norms = colorHistsSquaredNormsL2(imgs_color_hists)
+
+    number_of_imgs, histogram_length = imgs_color_hists.shape
+    number_of_queries = query_color_hists.shape[0]
+    topk = min(topk, number_of_imgs)
+    number_of_candidates = min(2 * topk, number_of_imgs)
+
+    top_indices = np.empty((number_of_queries, topk), dtype=np.int64)
+    top_distances = np.empty((number_of_queries, topk), dtype=np.float32)
+    if topk == 0:
+        # empty dataset, nothing to retrieve
+        return top_indices, top_distances, imgs_paths[top_indices]
+
+    if query_batch_size is None:
+        query_batch_size = max(1, DISTANCES_BUDGET // number_of_imgs)
+    for start in range(0, number_of_queries, query_batch_size):
+        queries = query_color_hists[start:start + query_batch_size]
+        distances = colorHistsPairwiseDistancesL2(imgs_color_hists, queries, imgs_squared_norms)
+
+        # unordered candidates closest to each query
+        if number_of_candidates < number_of_imgs:
+            candidates = np.argpartition(distances, number_of_candidates - 1, axis=1)[:, :number_of_candidates]
+        else:
+            candidates = np.broadcast_to(np.arange(number_of_imgs), distances.shape)
+
+        # exact distances for candidates, few queries at a time, so that gathered histograms fit into REFINE_BUDGET
+        refine_batch_size = max(1, REFINE_BUDGET // (number_of_candidates * histogram_length))
+        for refine_start in range(0, len(queries), refine_batch_size):
+            refine_candidates = candidates[refine_start:refine_start + refine_batch_size]
+            refine_queries = queries[refine_start:refine_start + refine_batch_size]
+            candidates_distances = np.sqrt(np.square(imgs_color_hists[refine_candidates] - refine_queries[:, np.newaxis]).sum(axis=2))
+
+            # small sort per query, stable in candidate index, so that ties resolve the same way as in full argsort
+            order = np.lexsort((refine_candidates, candidates_distances), axis=1)[:, :topk]
+            rows = slice(start + refine_start, start + refine_start + len(refine_queries))
+            top_indices[rows] = np.take_along_axis(refine_candidates, order, axis=1)
+            top_distances[rows] = np.take_along_axis(candidates_distances, order, axis=1)
+
+    top_imgs_paths = imgs_paths[top_indices]
+    return top_indices, top_distances, top_imgs_paths
+
+
 if __name__ == "__main__":
     # run from project folder (Content_based_image_retrieval).
     # assumed that project folder contains folder imgs with test images in it.
     # retrieve closest to the query images from dataset based on L2 distance between color histograms.
     import os
     import cv2
-    from hist import calcColorHistsCV2, calcColorHistCV2
+    from hist import calcColorHistCV2
+    from index import update_color_hists_index
 
 
     def resize_image(image, width=None, height=None):
@@ -55,19 +123,21 @@ if __name__ == "__main__":
 
 
     imgs_folder = 'imgs'
+    index_path = 'imgs_color_hists'
     histSize = 256
     ranges = [0, 256]
     query_imgs_paths = ['imgs/ukbench00004.jpg', 'imgs/ukbench00040.jpg', 'imgs/ukbench00060.jpg', 'imgs/ukbench00588.jpg', 'imgs/ukbench01562.jpg']
     topk = 10
     close_images_display_height = 128
 
+    # histograms are taken from on-disk index (memory-mapped), only new or changed images are decoded
     imgs_paths = [os.path.join(imgs_folder, path) for path in sorted(os.listdir(imgs_folder))]
-    imgs_color_hists = calcColorHistsCV2(imgs_paths, histSize=histSize, ranges=ranges)
+    imgs_paths, imgs_color_hists, _ = update_color_hists_index(index_path, imgs_paths, histSize=histSize, ranges=ranges, n_jobs=None)
 
     query_imgs = [cv2.imread(path, cv2.IMREAD_COLOR) for path in query_imgs_paths]
-    query_color_hists = [calcColorHistCV2(img, mask=None, histSize=histSize, ranges=ranges) for img in query_imgs]
+    query_color_hists = np.stack([calcColorHistCV2(img, mask=None, histSize=histSize, ranges=ranges) for img in query_imgs])
 
-    topk_imgs_paths = [find_similar_by_color_histograms(imgs_paths, imgs_color_hists, query, topk=topk) for query in query_color_hists]
+    _, _, topk_imgs_paths = find_similar_by_color_histograms_batch(imgs_paths, imgs_color_hists, query_color_hists, topk=topk)
 
     for query_img, close_imgs_paths in zip(query_imgs, topk_imgs_paths):
         # load close images in memory and change size, so that they all fit in screen
@@ -0,0 +1,259 @@
+import json
+import time
+import base64
+import binascii
+import asyncio
+import argparse
+import cv2
+import numpy as np
+
+from hist import calcColorHistCV2
+from index import load_color_hists_index
+from L2 import colorHistsSquaredNormsL2
+from query import find_similar_by_color_histograms_batch
+
+
+# Resident retrieval service: index is loaded (memory-mapped) once, concurrent requests are combined into batched searches.
+# Plain HTTP/1.1 on top of asyncio streams, JSON in and out, no GUI calls.
+#
+#   POST /query  {"histogram": [...]} | {"image": "<base64 encoded image file>"} | {"path": "<path of an indexed image>"}, optional "topk" (default 10)
+#                -> {"paths": [...], "distances": [...]}
+#                "path" only names an image of the index (as listed in it), its stored histogram is the query:
+#                the server never opens files clients point at.
+#   GET  /stats  -> latency and throughput counters
+MAX_BODY_SIZE = 64 * 2**20  # bytes, large enough for a base64 encoded photo
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class RetrievalService:
+    """Holds index and counters, micro-batches queries: waits up to max_wait_ms for max_batch_size queries, answers all of them with one search."""
+
+    def __init__(self, index_path, max_batch_size, max_wait_ms):
+        self.imgs_paths, self.imgs_color_hists, manifest = load_color_hists_index(index_path)
+        self.imgs_squared_norms = colorHistsSquaredNormsL2(self.imgs_color_hists)
+        self.rows = {path: row for row, path in enumerate(self.imgs_paths)}
+        self.histSize = manifest['histSize']
+        self.ranges = manifest['ranges']
+
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+
+        self.started = time.perf_counter()
+        self.stats = {'queries': 0, 'batches': 0, 'errors': 0, 'latency_sum_ms': 0., 'latency_max_ms': 0., 'search_sum_ms': 0.}
+
+    def color_hist(self, request):
+        """Color histogram of a query, whichever way it was supplied."""
+        if 'histogram' in request:
+            color_hist = np.asarray(request['histogram'], dtype=np.float32)
+            if color_hist.shape != (self.imgs_color_hists.shape[1],):
+                raise HTTPError(400, f"histogram should have {self.imgs_color_hists.shape[1]} values")
+            return color_hist
+
+        if 'path' in request:
+            row = self.rows.get(request['path']) if isinstance(request['path'], str) else None
+            if row is None:
+                raise HTTPError(404, "path is not in the index")
+            return np.asarray(self.imgs_color_hists[row], dtype=np.float32)
+
+        if 'image' not in request:
+            raise HTTPError(400, "expected one of 'histogram', 'image', 'path'")
+        try:
+            data = base64.b64decode(request['image'], validate=True)
+        except (binascii.Error, ValueError, TypeError):
+            raise HTTPError(400, "image is not valid base64")
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise HTTPError(400, "could not decode image")
+        return calcColorHistCV2(img, mask=None, histSize=self.histSize, ranges=self.ranges)
+
+    async def query(self, request):
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+
+        try:
+            topk = int(request.get('topk', 10))
+        except (TypeError, ValueError):
+            raise HTTPError(400, "topk should be an integer")
+        if topk < 1:
+            raise HTTPError(400, "topk should be positive")
+
+        # decoding and histogram in a thread, so that event loop keeps accepting requests
+        color_hist = await loop.run_in_executor(None, self.color_hist, request)
+
+        future = loop.create_future()
+        await self.queue.put((color_hist, topk, future))
+        paths, distances = await future
+
+        latency_ms = 1000 * (time.perf_counter() - start)
+        self.stats['latency_sum_ms'] += latency_ms
+        self.stats['latency_max_ms'] = max(self.stats['latency_max_ms'], latency_ms)
+        return {'paths': paths, 'distances': distances}
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # queries of clients that went away meanwhile (their handlers cancelled the futures) need no answer
+            batch = [item for item in batch if not item[2].done()]
+            if not batch:
+                continue
+
+            # whatever goes wrong with one batch is its queries' error, batcher itself has to keep serving the next ones
+            try:
+                await self.search(batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def search(self, batch):
+        """Answer a batch of (color_hist, topk, future) with a single search."""
+        loop = asyncio.get_running_loop()
+        query_color_hists = np.stack([color_hist for color_hist, _, _ in batch])
+        topk = max(topk for _, topk, _ in batch)
+
+        start = time.perf_counter()
+        _, top_distances, top_imgs_paths = await loop.run_in_executor(
+            None, find_similar_by_color_histograms_batch, self.imgs_paths, self.imgs_color_hists, query_color_hists, topk, self.imgs_squared_norms)
+        self.stats['search_sum_ms'] += 1000 * (time.perf_counter() - start)
+        self.stats['batches'] += 1
+        self.stats['queries'] += len(batch)
+
+        for (_, k, future), paths, distances in zip(batch, top_imgs_paths, top_distances):
+            # client may have gone away during the search
+            if not future.done():
+                future.set_result((paths[:k].tolist(), distances[:k].tolist()))
+
+    def counters(self):
+        uptime = time.perf_counter() - self.started
+        queries = max(self.stats['queries'], 1)
+        batches = max(self.stats['batches'], 1)
+        return {
+            'images': len(self.imgs_paths),
+            'queries': self.stats['queries'],
+            'batches': self.stats['batches'],
+            'errors': self.stats['errors'],
+            'mean_batch_size': self.stats['queries'] / batches,
+            'mean_latency_ms': self.stats['latency_sum_ms'] / queries,
+            'max_latency_ms': self.stats['latency_max_ms'],
+            'mean_search_ms_per_batch': self.stats['search_sum_ms'] / batches,
+            'queries_per_second': self.stats['queries'] / uptime,
+            'uptime_s': uptime,
+        }
+
+    async def handle(self, method, path, body):
+        if method == 'GET' and path == '/stats':
+            return self.counters()
+        if method == 'POST' and path == '/query':
+            try:
+                request = json.loads(body)
+            except ValueError:
+                raise HTTPError(400, "body should be JSON")
+            if not isinstance(request, dict):
+                raise HTTPError(400, "body should be JSON object")
+            return await self.query(request)
+        raise HTTPError(404, f"no route for {method} {path}")
+
+
+async def read_request(reader):
+    """Parse single HTTP/1.1 request: method, path, headers, body. None if connection closed."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_SIZE:
+        raise HTTPError(413, "request body too large")
+    body = await reader.readexactly(length) if length else b''
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive):
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+    body = json.dumps(payload).encode()
+    writer.write(f"HTTP/1.1 {status} {reasons.get(status, '')}\r\n"
+                 f"Content-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n"
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body)
+
+
+async def serve(service, host, port):
+    async def on_connection(reader, writer):
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    method, path, headers, body = request
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                    status, payload = 200, await service.handle(method, path, body)
+                except HTTPError as e:
+                    service.stats['errors'] += 1
+                    status, payload = e.status, {'error': str(e)}
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as e:
+                    service.stats['errors'] += 1
+                    status, payload = 500, {'error': repr(e)}
+
+                write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    batcher = asyncio.create_task(service.batcher())
+    server = await asyncio.start_server(on_connection, host, port)
+    print(f"serving {len(service.imgs_paths)} images on http://{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher.cancel()
+
+
+if __name__ == "__main__":
+    # run from project folder (Content_based_image_retrieval), after index is built (index.py).
+    # example query: curl -s -X POST localhost:8000/query -d '{"path": "imgs/ukbench00004.jpg", "topk": 4}'
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", help="path to color histograms index without suffix", default='imgs_color_hists')
+    parser.add_argument("--host", help="interface to listen on", default='127.0.0.1')
+    parser.add_argument("--port", help="port to listen on", type=int, default=8000)
+    parser.add_argument("--max_batch_size", help="maximum number of queries combined into one search", type=int, default=64)
+    parser.add_argument("--max_wait_ms", help="how long to wait for more queries before searching", type=float, default=2.)
+
+    args = parser.parse_args()
+
+    service = RetrievalService(args.index, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
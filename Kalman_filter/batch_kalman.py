@@ -0,0 +1,255 @@
+import numpy as np
+
+
+# Many independent tracks with the same linear model (F, H, Q, R), as filterpy.kalman.KalmanFilter per track would have,
+# but states and covariances stacked into arrays, so that predict / update of all tracks is a handful of numpy operations
+# instead of a python call (and a dozen of tiny dot products) per track.
+# Equations, and their order, are the ones of filterpy (including Joseph form of covariance update), results agree up to round-off.
+# Once covariances of tracks settle, gain stops changing: steady_state() precomputes it and from then on only states are updated.
+
+
+def _transpose(a):
+    return np.swapaxes(a, -1, -2)
+
+
+def _right(a, m):
+    """a @ m for stacked a [n, i, j] and shared m [j, k], as a single 2d product (stacked matmul loops over tiny matrices)."""
+    return (a.reshape(-1, a.shape[-1]) @ m).reshape(a.shape[:-1] + (m.shape[-1],))
+
+
+def _left(m, a):
+    """m @ a for shared m [i, j] and stacked a [n, j, k]."""
+    return _transpose(_right(_transpose(a), m.T))
+
+
+def _matrix(value, dim):
+    """Model matrix from value; scalar means scalar times identity (as filterpy treats scalar Q and R arguments)."""
+    if np.isscalar(value):
+        return np.eye(dim) * value
+    return np.array(value, dtype=np.float64).reshape(dim, dim)
+
+
+class BatchKalmanFilter:
+    """Kalman filters of n tracks sharing the same model.
+
+    Args:
+        dim_x: int, number of state variables
+        dim_z: int, number of measured variables
+        n: int, initial number of tracks (more can be added with add)
+
+    Attributes (same meaning as in filterpy.kalman.KalmanFilter, stacked over tracks):
+        x: numpy array [n, dim_x], states
+        P: numpy array [n, dim_x, dim_x], covariances
+        F: [dim_x, dim_x] state transition matrix, H: [dim_z, dim_x] measurement matrix,
+        Q: [dim_x, dim_x] process noise, R: [dim_z, dim_z] measurement noise (scalars are taken as multiples of identity)
+        K: [dim_x, dim_z] steady-state gain, None unless steady_state was called (then P stays as it is)
+    """
+    def __init__(self, dim_x, dim_z, n=0):
+        self.dim_x = dim_x
+        self.dim_z = dim_z
+        self.x = np.zeros((n, dim_x))
+        self.P = np.tile(np.eye(dim_x), (n, 1, 1))
+        self.F = np.eye(dim_x)
+        self.H = np.zeros((dim_z, dim_x))
+        self.Q = np.eye(dim_x)
+        self.R = np.eye(dim_z)
+        self.K = None
+        self._I = np.eye(dim_x)
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def __setattr__(self, name, value):
+        if name in ['F', 'Q']:
+            value = _matrix(value, self.dim_x)
+        elif name == 'R':
+            value = _matrix(value, self.dim_z)
+        elif name == 'H':
+            value = np.array(value, dtype=np.float64).reshape(self.dim_z, self.dim_x)
+        super().__setattr__(name, value)
+
+    def add(self, x, P=None):
+        """Start new tracks.
+
+        Args:
+            x: numpy array [m, dim_x], initial states
+            P: numpy array [m, dim_x, dim_x] or [dim_x, dim_x] (same for all) or scalar, initial covariances. If None - identity
+
+        Return:
+            indices: numpy array [m], indices of new tracks
+        """
+        x = np.array(x, dtype=np.float64).reshape(-1, self.dim_x)
+        P = self._I if P is None else _matrix(P, self.dim_x) if np.ndim(P) < 3 else np.asarray(P, dtype=np.float64)
+        indices = np.arange(len(self), len(self) + len(x))
+        self.x = np.concatenate([self.x, x])
+        self.P = np.concatenate([self.P, np.broadcast_to(P, (len(x), self.dim_x, self.dim_x))])
+        return indices
+
+    def remove(self, mask):
+        """Drop tracks where mask (bool [n]) is True; remaining tracks keep their order (and shift their indices)."""
+        keep = ~np.asarray(mask, dtype=bool)
+        self.x = self.x[keep]
+        self.P = self.P[keep]
+
+    def predict(self):
+        """x = Fx, P = FPF' + Q for all tracks (only x with steady-state gain)."""
+        self.x = self.x @ self.F.T
+        if self.K is None:
+            self.P = _left(self.F, _right(self.P, self.F.T)) + self.Q
+
+    def update(self, z, mask=None):
+        """Correct tracks with their measurements.
+
+        Args:
+            z: numpy array [n, dim_z], measurements, in order of tracks
+            mask: numpy array bool [n], which tracks are measured (the rest is left as is, like filterpy update(None)).
+                  Rows of z of unmeasured tracks are ignored (may be anything, e.g. NaN). If None - all tracks are measured
+        """
+        z = np.asarray(z, dtype=np.float64).reshape(-1, self.dim_z)
+        if mask is None:
+            indices = slice(None)
+        else:
+            indices = np.flatnonzero(mask)
+            z = z[indices]
+        x = self.x[indices]
+
+        # y = z - Hx, residual between measurement and prediction
+        y = z - x @ self.H.T
+
+        if self.K is not None:
+            self.x[indices] = x + y @ self.K.T
+            return
+
+        P = self.P[indices]
+        PHT = _right(P, self.H.T)
+        S = _left(self.H, PHT) + self.R
+        K = PHT @ np.linalg.inv(S)
+        self.x[indices] = x + (K @ y[..., np.newaxis])[..., 0]
+
+        # P = (I-KH)P(I-KH)' + KRK', Joseph form (as in filterpy), stays symmetric and positive definite
+        I_KH = self._I - _right(K, self.H)
+        self.P[indices] = I_KH @ P @ _transpose(I_KH) + _right(K, self.R) @ _transpose(K)
+
+    def steady_state(self, P=None, max_iter=10000, tolerance=1e-12):
+        """Switch to steady-state gain: iterate predict/update of covariance until it stops changing, fix the gain.
+
+        After that update is x = x + K(z - Hx) for every measured track, and P is no longer updated (all tracks are assumed settled).
+        Unmeasured tracks are not accounted for, their uncertainty does not grow. Set K to None to switch back.
+
+        Args:
+            P: numpy array [dim_x, dim_x], covariance to start iterations from. If None - identity
+            max_iter: int, maximum number of iterations
+            tolerance: float, max change of covariance under which it is assumed converged
+
+        Return:
+            K: numpy array [dim_x, dim_z], steady-state gain
+        """
+        P = self._I if P is None else _matrix(P, self.dim_x)
+        for i in range(max_iter):
+            P_prior = self.F @ P @ self.F.T + self.Q
+            S = self.H @ P_prior @ self.H.T + self.R
+            K = P_prior @ self.H.T @ np.linalg.inv(S)
+            I_KH = self._I - K @ self.H
+            P_next = I_KH @ P_prior @ I_KH.T + K @ self.R @ K.T
+            converged = np.max(np.abs(P_next - P)) < tolerance
+            P = P_next
+            if converged:
+                break
+        else:
+            raise ValueError(f"covariance did not converge in {max_iter} iterations, model may have no steady state")
+
+        self.K = K
+        self.P = np.tile(P, (len(self), 1, 1))
+        return K
+
+
+if __name__ == "__main__":
+    # throughput of n filterpy.kalman.KalmanFilter objects versus BatchKalmanFilter of n tracks, same model as in mouseCapture.py
+    # (constant velocity, state [x, vx, y, vy]), position measured, a share of measurements missing
+    import time
+    import argparse
+
+    from filterpy.kalman import KalmanFilter
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tracks", help="numbers of tracks to run", nargs='+', type=int, default=[10, 100, 1000])
+    parser.add_argument("--steps", help="number of predict/update steps", type=int, default=50)
+    parser.add_argument("--missing", help="probability that measurement of a track is missing in a step", type=float, default=0.1)
+    parser.add_argument("--seed", help="random seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    dt_s = 0.04
+    F = np.array([[1., dt_s, 0., 0.],
+                  [0., 1., 0., 0.],
+                  [0., 0., 1., dt_s],
+                  [0., 0., 0., 1.]])
+    H = np.array([[1., 0., 0., 0.],
+                  [0., 0., 1., 0.]])
+    Q = np.diag([0., 3., 0., 3.])
+    R = np.eye(2) * 20.
+
+    def make_filterpy(x0):
+        kalman_filter = KalmanFilter(dim_x=4, dim_z=2)
+        kalman_filter.x = x0.reshape(4, 1).copy()
+        kalman_filter.F, kalman_filter.H, kalman_filter.Q, kalman_filter.R = F, H, Q, R
+        return kalman_filter
+
+    def make_batch(x0):
+        batch = BatchKalmanFilter(dim_x=4, dim_z=2)
+        batch.F, batch.H, batch.Q, batch.R = F, H, Q, R
+        batch.add(x0)
+        return batch
+
+    rng = np.random.default_rng(args.seed)
+    for n in args.tracks:
+        x0 = rng.normal(0., 100., (n, 4))
+        zs = rng.normal(0., 100., (args.steps, n, 2))
+        masks = rng.random((args.steps, n)) >= args.missing
+
+        # full covariance update
+        filters = [make_filterpy(x) for x in x0]
+        start = time.perf_counter()
+        for z, mask in zip(zs, masks):
+            for kalman_filter, z_i, measured in zip(filters, z, mask):
+                kalman_filter.predict()
+                kalman_filter.update(z_i if measured else None)
+        filterpy_seconds = time.perf_counter() - start
+
+        batch = make_batch(x0)
+        start = time.perf_counter()
+        for z, mask in zip(zs, masks):
+            batch.predict()
+            batch.update(z, mask)
+        batch_seconds = time.perf_counter() - start
+
+        x_error = np.max(np.abs(batch.x - np.array([kalman_filter.x[:, 0] for kalman_filter in filters])))
+        P_error = np.max(np.abs(batch.P - np.array([kalman_filter.P for kalman_filter in filters])))
+
+        # steady-state gain
+        batch = make_batch(x0)
+        K = batch.steady_state()
+        filters = [make_filterpy(x) for x in x0]
+        for kalman_filter in filters:
+            kalman_filter.K = K
+        start = time.perf_counter()
+        for z, mask in zip(zs, masks):
+            for kalman_filter, z_i, measured in zip(filters, z, mask):
+                kalman_filter.predict_steadystate()
+                kalman_filter.update_steadystate(z_i if measured else None)
+        filterpy_steady_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for z, mask in zip(zs, masks):
+            batch.predict()
+            batch.update(z, mask)
+        batch_steady_seconds = time.perf_counter() - start
+
+        steady_error = np.max(np.abs(batch.x - np.array([kalman_filter.x[:, 0] for kalman_filter in filters])))
+
+        track_steps = n * args.steps
+        print(f"tracks: {n}, track-steps per second: "
+              f"filterpy {track_steps / filterpy_seconds:.0f}, batch {track_steps / batch_seconds:.0f} ({filterpy_seconds / batch_seconds:.0f}x), "
+              f"filterpy steady-state {track_steps / filterpy_steady_seconds:.0f}, batch steady-state {track_steps / batch_steady_seconds:.0f} "
+              f"({filterpy_steady_seconds / batch_steady_seconds:.0f}x); "
+              f"max difference: x {x_error:.1e}, P {P_error:.1e}, steady-state x {steady_error:.1e}")
@@ -67,7 +67,7 @@ if __name__ == "__main__":
 
     kalman_filter.H = np.eye(4, dtype=np.float32)       # Measurement matrix: identity transform here
     kalman_filter.R = 1.                                # State uncertainty
-    KalmanFilter.Q = np.diag([0., 3., 0., 3.])          # Process uncertainty
+    kalman_filter.Q = np.diag([0., 3., 0., 3.])         # Process uncertainty
     kalman_filter.P = 0.                                # Covariance matrix (initial)
 
     fourcc = cv2.VideoWriter_fourcc(*'XVID')
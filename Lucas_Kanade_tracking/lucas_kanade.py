@@ -0,0 +1,262 @@
+import cv2
+import time
+import numpy as np
+import argparse
+
+
+# Inverse compositional affine Lucas-Kanade (Baker & Matthews, "Lucas-Kanade 20 Years On").
+# Warp W(x; p) maps template coordinates (x, y) to image coordinates:
+#   W(x; p) = [[1 + p1, p3, p5],   @ [x, y, 1]^T
+#              [p2, 1 + p4, p6]]
+# (same parameter layout as construct_warp_matrix_affine in the notebook, order='F').
+# Everything that depends on template only (gradients, steepest descent images, inverse Hessian) is computed once,
+# so that every iteration is a single warp of the image and a single 6-vector reduction.
+#
+# Forward additive variant (as in the notebook) needs image gradients instead. Only the part of the frame under the warped template
+# is ever sampled, so RegionGradients computes them lazily for bounding region of the warp (plus margin) and caches them per frame.
+
+
+def affine_warp_matrix(p):
+    """2x3 matrix of warp W(x; p)."""
+    M = np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)  # identity transformation
+    M = M + np.asarray(p, dtype=np.float64).reshape(2, 3, order='F')
+    return M
+
+
+def affine_warp_parameters(M):
+    """Inverse of affine_warp_matrix."""
+    return (M[:2] - np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)).reshape(-1, order='F')
+
+
+def initial_parameters(bbox):
+    """Warp that maps template onto bbox (x,y-coordinates of left-top corner, width, height) by translation only."""
+    p = np.zeros(6, dtype=np.float64)
+    p[4] = bbox[0]
+    p[5] = bbox[1]
+    return p
+
+
+def template_gradients(template):
+    """Central differences of template along x and y (replicated border, so that output has the same shape)."""
+    pad = 1
+    grad_x_kernel = np.array([[-0.5, 0, 0.5]], dtype=np.float64)
+    grad_y_kernel = grad_x_kernel.T
+    padded = cv2.copyMakeBorder(template, pad, pad, pad, pad, cv2.BORDER_REPLICATE)
+    dT_dx = cv2.filter2D(padded, ddepth=-1, kernel=grad_x_kernel)[pad:-pad, pad:-pad]  # filter2D is correlation, so kernel is not flipped
+    dT_dy = cv2.filter2D(padded, ddepth=-1, kernel=grad_y_kernel)[pad:-pad, pad:-pad]
+    return dT_dx, dT_dy
+
+
+class RegionGradients:
+    """Image gradients (same as template_gradients of the whole image) computed only for a region, which grows on demand.
+
+    Args:
+        img: numpy array, grayscale image
+        margin: int, pixels added around requested region on every (re)computation, so that small warp updates do not trigger it
+        dtype: numpy dtype of gradients, float32 halves memory traffic compared to float64
+    """
+
+    def __init__(self, img, margin=8, dtype=np.float32):
+        self.img = img
+        self.margin = margin
+        self.dtype = dtype
+        self.region = None  # x1, y1, x2, y2 (exclusive) of computed gradients
+        self.dI_dx = None  # frame sized, valid within region only
+        self.dI_dy = None
+        self.computed_pixels = 0  # total area of all (re)computations
+
+    def ensure(self, x1, y1, x2, y2):
+        """Make sure gradients cover region (clipped to the image), recompute for union with current region plus margin otherwise."""
+        height, width = self.img.shape[:2]
+        # outside of the image replicated border is sampled, so at least the nearest edge pixels are needed
+        x1, y1 = min(max(x1, 0), width - 1), min(max(y1, 0), height - 1)
+        x2, y2 = max(min(x2, width), x1 + 1), max(min(y2, height), y1 + 1)
+        if self.region is not None:
+            rx1, ry1, rx2, ry2 = self.region
+            if rx1 <= x1 and ry1 <= y1 and x2 <= rx2 and y2 <= ry2:
+                return
+            x1, y1, x2, y2 = min(x1, rx1), min(y1, ry1), max(x2, rx2), max(y2, ry2)
+        x1, y1 = max(x1 - self.margin, 0), max(y1 - self.margin, 0)
+        x2, y2 = min(x2 + self.margin, width), min(y2 + self.margin, height)
+
+        # one pixel of context from the image where there is one, replicated border where there is not (as for the whole image)
+        cx1, cy1, cx2, cy2 = max(x1 - 1, 0), max(y1 - 1, 0), min(x2 + 1, width), min(y2 + 1, height)
+        dI_dx, dI_dy = template_gradients(self.img[cy1:cy2, cx1:cx2].astype(self.dtype))
+        if self.dI_dx is None:
+            # frame sized, so that warps sample gradients at the very same coordinates as gradients of the whole image
+            # (warpAffine of float32 rounds coordinates differently once they are shifted to a region);
+            # zeros are mapped lazily, only pages of computed regions are ever touched
+            self.dI_dx = np.zeros((height, width), dtype=self.dtype)
+            self.dI_dy = np.zeros((height, width), dtype=self.dtype)
+        self.dI_dx[y1:y2, x1:x2] = dI_dx[y1 - cy1:y2 - cy1, x1 - cx1:x2 - cx1]
+        self.dI_dy[y1:y2, x1:x2] = dI_dy[y1 - cy1:y2 - cy1, x1 - cx1:x2 - cx1]
+        self.region = (x1, y1, x2, y2)
+        self.computed_pixels += (x2 - x1) * (y2 - y1)
+
+    def warp(self, M, size):
+        """Gradients sampled at W(x) for x on template grid of size (width, height), M - 2x3 matrix of W (template to image coordinates)."""
+        width, height = size
+        corners = np.array([[0, 0, 1], [width - 1, 0, 1], [width - 1, height - 1, 1], [0, height - 1, 1]], dtype=np.float64) @ M.T
+        x1, y1 = (int(v) - 1 for v in np.floor(corners.min(axis=0)))  # bilinear interpolation takes neighbours
+        x2, y2 = (int(v) + 2 for v in np.ceil(corners.max(axis=0)))
+        self.ensure(x1, y1, x2, y2)
+
+        flags = cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP
+        dI_dx = cv2.warpAffine(self.dI_dx, M, size, flags=flags, borderMode=cv2.BORDER_REPLICATE)
+        dI_dy = cv2.warpAffine(self.dI_dy, M, size, flags=flags, borderMode=cv2.BORDER_REPLICATE)
+        return dI_dx, dI_dy
+
+
+def precompute_template(template, translation_only=False):
+    """Template dependent part of inverse compositional algorithm.
+
+    Args:
+        template: numpy array, grayscale template
+        translation_only: bool, estimate only p5, p6 (translation), the rest of parameters stays as given. Better conditioned for small templates
+
+    Return:
+        template_data: dict with template (float32), indices of estimated parameters, steepest descent images of shape [number_of_pixels, number_of_parameters] and inverse Hessian
+    """
+    template = np.asarray(template, dtype=np.float32)
+    dT_dx, dT_dy = template_gradients(template.astype(np.float64))
+
+    # Jacobian of warp at p = 0: dW/dp = [[x, 0, y, 0, 1, 0], [0, x, 0, y, 0, 1]], x - column, y - row
+    y, x = np.mgrid[0:template.shape[0], 0:template.shape[1]]
+    sd = np.stack([x*dT_dx, x*dT_dy, y*dT_dx, y*dT_dy, dT_dx, dT_dy], axis=-1).reshape(-1, 6)
+    parameters = np.array([4, 5]) if translation_only else np.arange(6)
+    sd = np.ascontiguousarray(sd[:, parameters])
+
+    H = sd.T @ sd
+    return {'template': template, 'parameters': parameters, 'sd': sd, 'hessian_inv': np.linalg.pinv(H)}
+
+
+def lucas_kanade_affine(img, template_data, p, stop_criteria):
+    """Align template to image with inverse compositional affine Lucas-Kanade.
+
+    Args:
+        img: numpy array float32, grayscale image
+        template_data: dict, output of precompute_template
+        p: numpy array of 6 floats, initial warp parameters (e.g. initial_parameters(bbox) or result for the previous frame)
+        stop_criteria: dict, where 'max_iter' - maximum number of iterations, so that we do not stuck eternally, 'epsilon' - norm of parameters update under which we assume convergence.
+
+    Return:
+        ret: bool, whether process converged (True), or has been stopped after maximum number of iterations (False)
+        p: numpy array of 6 floats, updated warp parameters
+        iterations: int, number of iterations done
+    """
+    max_iter = stop_criteria['max_iter']
+    epsilon = stop_criteria['epsilon']
+
+    template = template_data['template']
+    sd = template_data['sd']
+    hessian_inv = template_data['hessian_inv']
+    parameters = template_data['parameters']
+    template_size = template.shape[::-1]
+
+    A = np.eye(3)
+    A[:2] = affine_warp_matrix(p)
+
+    ret = False
+    iterations = 0
+    for iterations in range(1, max_iter + 1):
+        # I(W(x; p)) sampled on template grid
+        I = cv2.warpAffine(img, A[:2], template_size, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+        error_image = I.astype(np.float64) - template
+        dp = np.zeros(6)
+        dp[parameters] = hessian_inv @ (sd.T @ error_image.reshape(-1))
+
+        # W(x; p) <- W(x; p) o W(x; dp)^-1
+        A_dp = np.eye(3)
+        A_dp[:2] = affine_warp_matrix(dp)
+        A = A @ np.linalg.inv(A_dp)
+
+        if np.linalg.norm(dp) < epsilon:
+            ret = True
+            break
+
+    return ret, affine_warp_parameters(A), iterations
+
+
+def lucas_kanade_affine_forward_additive(img, template, p, stop_criteria, gradients=None):
+    """Align template to image with forward additive affine Lucas-Kanade (formulation of the notebook), gradients restricted to the warp region.
+
+    Args:
+        img: numpy array float32, grayscale image
+        template: numpy array, grayscale template
+        p: numpy array of 6 floats, initial warp parameters
+        stop_criteria: dict, where 'max_iter' - maximum number of iterations, so that we do not stuck eternally, 'epsilon' - norm of parameters update under which we assume convergence.
+        gradients: RegionGradients of img, to share computed gradients between calls on the same frame. If None - new one (float32, margin 8)
+
+    Return:
+        ret: bool, whether process converged (True), or has been stopped after maximum number of iterations (False)
+        p: numpy array of 6 floats, updated warp parameters
+        iterations: int, number of iterations done
+    """
+    max_iter = stop_criteria['max_iter']
+    epsilon = stop_criteria['epsilon']
+
+    if gradients is None:
+        gradients = RegionGradients(img)
+    template = np.asarray(template, dtype=np.float64)
+    template_size = template.shape[::-1]
+    y, x = np.mgrid[0:template.shape[0], 0:template.shape[1]]
+
+    p = np.array(p, dtype=np.float64)
+    ret = False
+    iterations = 0
+    for iterations in range(1, max_iter + 1):
+        M = affine_warp_matrix(p)
+        I = cv2.warpAffine(img, M, template_size, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+        dI_dx, dI_dy = gradients.warp(M, template_size)
+
+        sd = np.stack([x*dI_dx, x*dI_dy, y*dI_dx, y*dI_dy, dI_dx, dI_dy], axis=-1).reshape(-1, 6).astype(np.float64)
+        error_image = template - I
+        dp = np.linalg.pinv(sd.T @ sd) @ (sd.T @ error_image.reshape(-1))
+        p = p + dp
+
+        if np.linalg.norm(dp) < epsilon:
+            ret = True
+            break
+
+    return ret, p, iterations
+
+
+def warped_corners(p, template_shape):
+    """Corners of template (top-left, top-right, bottom-right, bottom-left) in image coordinates."""
+    height, width = template_shape
+    corners = np.array([[0, 0, 1], [width - 1, 0, 1], [width - 1, height - 1, 1], [0, height - 1, 1]], dtype=np.float64)
+    return corners @ affine_warp_matrix(p).T
+
+
+# example query:
+# ./imgs/Bolt/img/0002.jpg ./imgs/Bolt/img/0001.jpg 336 165 26 61
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("img", help="string path to the image to align template to")
+    parser.add_argument("template", help="string path to the image to take template from")
+    parser.add_argument("bbox", help="template region, x,y-coordinates of left-top corner, width, height; also initial position in img", nargs=4, type=int)
+    parser.add_argument("--max_iter", help="maximum number of iterations", type=int, default=100)
+    parser.add_argument("--epsilon", help="norm of parameters update under which we assume convergence", type=float, default=1e-2)
+    parser.add_argument("--method", help="inverse compositional (template gradients precomputed) or forward additive (as in the notebook)",
+                        choices=['inverse_compositional', 'forward_additive'], default='inverse_compositional')
+
+    args = parser.parse_args()
+
+    x, y, w, h = args.bbox
+    img = cv2.imread(args.img, cv2.IMREAD_GRAYSCALE).astype(np.float32)
+    template = cv2.imread(args.template, cv2.IMREAD_GRAYSCALE).astype(np.float32)[y:y + h, x:x + w]
+
+    stop_criteria = {'max_iter': args.max_iter, 'epsilon': args.epsilon}
+    start = time.perf_counter()
+    if args.method == 'inverse_compositional':
+        template_data = precompute_template(template)
+        ret, p, iterations = lucas_kanade_affine(img, template_data, initial_parameters(args.bbox), stop_criteria)
+    else:
+        gradients = RegionGradients(img)
+        ret, p, iterations = lucas_kanade_affine_forward_additive(img, template, initial_parameters(args.bbox), stop_criteria, gradients=gradients)
+        print(f"Gradients computed for {gradients.computed_pixels} pixels of {img.size}")
+    elapsed = time.perf_counter() - start
+
+    print("Converged:", ret, "Iterations:", iterations, f"Time: {1000 * elapsed:.2f}ms")
+    print("p:", np.round(p, 4))
+    print("Corners:", np.round(warped_corners(p, template.shape), 1).tolist())
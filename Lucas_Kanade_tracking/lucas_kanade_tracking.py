@@ -0,0 +1,179 @@
+import os
+import sys
+import cv2
+import time
+import numpy as np
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))  # repository root, for frame_source
+from frame_source import prefetch, iter_frames, decode_frame
+from lucas_kanade import precompute_template, lucas_kanade_affine, affine_warp_matrix, initial_parameters, warped_corners
+
+
+# Affine Lucas-Kanade through a sequence of frames.
+# Each frame is aligned coarse-to-fine over a Gaussian pyramid (large motion becomes small at coarse levels),
+# and is started from the parameters found for the previous frame (warm start), instead of the initial bbox.
+# Coarse levels estimate translation only: their templates are a few pixels wide, which does not constrain the affine part.
+# Frames are decoded by a background thread, ahead of the tracker.
+
+
+def gaussian_pyramid(img, levels):
+    """List of images, from the original (level 0) to the coarsest (level levels - 1), each next one blurred and halved with cv2.pyrDown."""
+    pyramid = [img]
+    for _ in range(levels - 1):
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
+
+def pyramid_levels(template_shape, levels, min_template_side=8):
+    """Number of pyramid levels that keeps template side at least min_template_side pixels at the coarsest level."""
+    levels_fit = 1
+    height, width = template_shape
+    while levels_fit < levels and min(height, width) >> levels_fit >= min_template_side:
+        levels_fit += 1
+    return levels_fit
+
+
+def scale_parameters(p, factor):
+    """Warp parameters for image and template both resized by factor: linear part is scale invariant, translation scales."""
+    p = np.array(p, dtype=np.float64)
+    p[4:] *= factor
+    return p
+
+
+def precompute_template_pyramid(anchor, bbox, levels):
+    """precompute_template for every pyramid level (translation only at coarse levels), template of each level is cropped from the same level of anchor frame pyramid.
+
+    Cropping (rather than downsampling the template itself) keeps pixels near template border blurred with real surroundings,
+    which matters for small coarse level templates.
+    """
+    templates_data = []
+    p = initial_parameters(bbox)
+    for level, img in enumerate(gaussian_pyramid(np.asarray(anchor, dtype=np.float32), levels)):
+        factor = 1 / 2**level
+        size = (max(int(round(bbox[2] * factor)), 1), max(int(round(bbox[3] * factor)), 1))
+        template = cv2.warpAffine(img, affine_warp_matrix(scale_parameters(p, factor)), size, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+        templates_data.append(precompute_template(template, translation_only=level > 0))
+    return templates_data
+
+
+def lucas_kanade_affine_pyramid(img_pyramid, templates_data, p, stop_criteria):
+    """Coarse-to-fine affine Lucas-Kanade: result of every level initializes the next finer one.
+
+    Args:
+        img_pyramid: list of numpy arrays float32, output of gaussian_pyramid, at least as many levels as templates_data
+        templates_data: list of dicts, output of precompute_template_pyramid
+        p: numpy array of 6 floats, initial warp parameters at level 0 (original resolution)
+        stop_criteria: dict, where 'max_iter' - maximum number of iterations per level, 'epsilon' - norm of parameters update under which we assume convergence.
+
+    Return:
+        ret: bool, whether the finest level converged
+        p: numpy array of 6 floats, warp parameters at level 0
+        iterations: int, total number of iterations over all levels
+    """
+    levels = len(templates_data)
+    p = scale_parameters(p, 1 / 2**(levels - 1))
+    ret = False
+    iterations = 0
+    for level in reversed(range(levels)):
+        ret, p, level_iterations = lucas_kanade_affine(img_pyramid[level], templates_data[level], p, stop_criteria)
+        iterations += level_iterations
+        if level > 0:
+            p = scale_parameters(p, 2)
+    return ret, p, iterations
+
+
+def read_frames(frames_paths, frames=None):
+    """Decode frames as float32 grayscale images, one by one.
+
+    Args:
+        frames_paths: list of strings, paths to frames
+        frames: iterable of numpy arrays uint8, grayscale frames to take instead of decoding frames_paths (e.g. frame_source.iter_frames with 'gray' conversion)
+    """
+    if frames is None:
+        frames = (decode_frame(path, 'gray') for path in frames_paths)
+    for frame in frames:
+        yield frame.astype(np.float32)
+
+
+def prefetch_frames(frames_paths, queue_size=8, frames=None):
+    """read_frames in a background thread, keeping at most queue_size frames ahead of the consumer (see frame_source.prefetch)."""
+    return prefetch(read_frames(frames_paths, frames), queue_size)
+
+
+def track_affine(frames, anchor, bbox, stop_criteria, levels=3, min_template_side=8, warm_start=True):
+    """Track template through a sequence of frames with pyramidal affine Lucas-Kanade.
+
+    Args:
+        frames: iterable of numpy arrays float32, grayscale frames
+        anchor: numpy array float32, grayscale frame to take template from, usually the first frame
+        bbox: x,y-coordinates of left-top corner, width, height of template in anchor frame, also initial position
+        stop_criteria: dict, where 'max_iter' - maximum number of iterations per level, 'epsilon' - norm of parameters update under which we assume convergence.
+        levels: int, maximum number of pyramid levels (fewer are used if template would get smaller than min_template_side)
+        min_template_side: int, smallest template side at the coarsest level
+        warm_start: bool, start each frame from previous frame parameters (True) or from initial bbox (False)
+
+    Return (yield, per frame):
+        p: numpy array of 6 floats, warp parameters (template coordinates to frame coordinates)
+        ret: bool, whether the finest level converged
+        iterations: int, total number of iterations over all levels
+        seconds: float, time spent on the frame (pyramid and alignment, without decoding)
+    """
+    levels = pyramid_levels((bbox[3], bbox[2]), levels, min_template_side)
+    templates_data = precompute_template_pyramid(anchor, bbox, levels)
+
+    p_initial = initial_parameters(bbox)
+    p = p_initial
+    for frame in frames:
+        start = time.perf_counter()
+        img_pyramid = gaussian_pyramid(frame, levels)
+        ret, p, iterations = lucas_kanade_affine_pyramid(img_pyramid, templates_data, p if warm_start else p_initial, stop_criteria)
+        yield p, ret, iterations, time.perf_counter() - start
+
+
+# example query:
+# ./imgs/Bolt/img ./imgs/Bolt/img/0001.jpg 336 165 26 61 --levels 3
+# ./imgs/Bolt/img ./imgs/Bolt/img/0001.jpg 336 165 26 61 --levels 3 --cache
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset", help="string path to the folder with frames to track through")
+    parser.add_argument("anchor", help="string path to the frame to take template from, usually first frame in sequence")
+    parser.add_argument("bbox", help="template region in anchor frame, x,y-coordinates of left-top corner, width, height", nargs=4, type=int)
+    parser.add_argument("--levels", help="maximum number of Gaussian pyramid levels", type=int, default=3)
+    parser.add_argument("--max_iter", help="maximum number of iterations per level", type=int, default=50)
+    parser.add_argument("--epsilon", help="norm of parameters update under which we assume convergence", type=float, default=1e-2)
+    parser.add_argument("--cold_start", help="start every frame from the initial bbox instead of previous frame parameters", action='store_true')
+    parser.add_argument("--queue_size", help="how many decoded frames reader may keep ahead of the tracker", type=int, default=8)
+    parser.add_argument("--output", help="file to write per frame results to (frame path, p1..p6, iterations, converged, seconds)", default=None)
+    parser.add_argument("--cache", help="take decoded frames from the frame cache next to dataset folder, decoding (and caching) them on the first run",
+                        action='store_true')
+
+    args = parser.parse_args()
+
+    frames_paths = [os.path.join(args.dataset, path) for path in sorted(os.listdir(args.dataset))]
+
+    _, _, w, h = args.bbox
+    anchor = cv2.imread(args.anchor, cv2.IMREAD_GRAYSCALE).astype(np.float32)
+    stop_criteria = {'max_iter': args.max_iter, 'epsilon': args.epsilon}
+
+    output = open(args.output, 'w') if args.output else None
+    total_seconds = 0.
+    total_iterations = 0
+    converged = 0
+    start = time.perf_counter()
+    cached_frames = iter_frames(args.dataset, 'gray', build_cache=True) if args.cache else None
+    frames = prefetch_frames(frames_paths, args.queue_size, frames=cached_frames)
+    for path, (p, ret, iterations, seconds) in zip(frames_paths, track_affine(frames, anchor, args.bbox, stop_criteria,
+                                                                            levels=args.levels, warm_start=not args.cold_start)):
+        total_seconds += seconds
+        total_iterations += iterations
+        converged += ret
+        if output:
+            output.write(f"{path},{','.join(f'{v:.6f}' for v in p)},{iterations},{int(ret)},{seconds:.6f}\n")
+    wall_seconds = time.perf_counter() - start
+    if output:
+        output.close()
+
+    print(f"frames: {len(frames_paths)}, converged: {converged}, mean iterations per frame: {total_iterations / len(frames_paths):.2f}")
+    print(f"tracking FPS: {len(frames_paths) / total_seconds:.1f}, end-to-end FPS (with decoding): {len(frames_paths) / wall_seconds:.1f}")
+    print("last frame corners:", np.round(warped_corners(p, (h, w)), 1).tolist())
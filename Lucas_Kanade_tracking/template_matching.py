@@ -1,6 +1,11 @@
 import cv2
+import time
 import numpy as np
 import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+CONJ_FFTS_CACHE_SIZE = 8  # conjugated template FFTs kept per template, one per FFT shape (i.e. per size of searched image or region)
 
 
 def get_margins(side_length):
@@ -32,7 +37,190 @@ def NCC(img_patch, template):
     return np.nanmean(img_patch * template) / normalization
 
 
-def template_match_map(img, template, criteria):
+CRITERIA_TYPES = {SAD: 'sad', SSD: 'ssd', NCC: 'ncc'}  # criteria with vectorized implementation
+SAD_BLOCK_ELEMENTS = 2**16  # number of output elements per block in SAD (256 KiB of float32 accumulator), stays in cache
+
+
+def _valid_ranges(img_length, template_length):
+    """For every position along one axis: [start, end) of template indices that overlap the image (the rest falls onto NaN padding)."""
+    before, _ = get_margins(template_length)
+    positions = np.arange(img_length)
+    start = np.maximum(before - positions, 0)
+    end = np.minimum(template_length, img_length - positions + before)
+    return start, end
+
+
+def _rectangle_sums(integral, rows_start, rows_end, cols_start, cols_end):
+    """Sums over rectangles [rows_start, rows_end) x [cols_start, cols_end) for every combination of rows and cols, given integral image (with leading zero row and column)."""
+    # rows first (small intermediate of shape [len(rows), integral_width]), then columns
+    row_differences = np.take(integral, rows_end, axis=0) - np.take(integral, rows_start, axis=0)
+    return np.take(row_differences, cols_end, axis=1) - np.take(row_differences, cols_start, axis=1)
+
+
+def _box_sums(integral, y_offset, x_offset, height, width, box_height, box_width):
+    """Sums over all boxes of size box_height x box_width with top-left corners at [y_offset, y_offset + height) x [x_offset, x_offset + width)."""
+    y1, x1 = y_offset + box_height, x_offset + box_width
+    return (integral[y1:y1 + height, x1:x1 + width] - integral[y_offset:y_offset + height, x1:x1 + width]
+            - integral[y1:y1 + height, x_offset:x_offset + width] + integral[y_offset:y_offset + height, x_offset:x_offset + width])
+
+
+def _integral(values):
+    """Integral image in float64 with leading zero row and column, so that sum of values[y0:y1, x0:x1] is a 4-point lookup."""
+    integral = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(values, axis=0, dtype=np.float64), axis=1, out=integral[1:, 1:])
+    return integral
+
+
+def image_statistics(img, templates_shapes, criteria_type):
+    """Everything about image that vectorized criteria need, computed once and shared by any number of templates (of any sizes).
+
+    Image is zero padded by the largest margins among templates, every template then reads it at its own offset.
+
+    Args:
+        img: numpy array, grayscale image
+        templates_shapes: list of (height, width) of templates to be matched against image
+        criteria_type: string, 'sad', 'ssd' or 'ncc', defines which statistics to compute
+
+    Return:
+        statistics: dict with image shape, padding margins, padded image (float32 for SAD),
+            and its FFT and integral image of squares (SSD, NCC)
+    """
+    margins = np.array([get_margins(height) + get_margins(width) for height, width in templates_shapes])
+    top_margin, bottom_margin, left_margin, right_margin = margins.max(axis=0)
+
+    # zero padding contributes nothing to sums, so they come out as sums over valid (inside image) pixels only
+    padded_img = np.pad(img.astype(np.float64), ((top_margin, bottom_margin), (left_margin, right_margin)), mode='constant', constant_values=0)
+    statistics = {'shape': img.shape, 'top_margin': top_margin, 'left_margin': left_margin}
+
+    if criteria_type == 'sad':
+        statistics['padded_float32'] = padded_img.astype(np.float32)
+    else:
+        statistics['fft_shape'] = tuple(cv2.getOptimalDFTSize(side) for side in padded_img.shape)
+        statistics['padded_fft'] = np.fft.rfft2(padded_img, s=statistics['fft_shape'])
+        statistics['sq_integral'] = _integral(np.square(padded_img))
+    return statistics
+
+
+def template_statistics(template):
+    """Everything about template that vectorized criteria need, computed once and reused for any number of images.
+
+    Return:
+        statistics: dict with template (float64 and float32), integral images of its squares and absolute values,
+            and cache of conjugated template FFTs per FFT shape (filled on demand, CONJ_FFTS_CACHE_SIZE most recently used shapes are kept)
+    """
+    template = np.asarray(template)
+    statistics = {
+        'template': template.astype(np.float64),
+        'template_float32': template.astype(np.float32),
+        'sq_integral': _integral(np.square(template.astype(np.float64))),
+        'abs_integral': _integral(np.abs(template.astype(np.float64))),
+        'conj_ffts': OrderedDict(),
+    }
+    return statistics
+
+
+def _template_offsets(img_statistics, template_shape):
+    """Where (in padded image) the patch of template centered at pixel (0, 0) starts."""
+    top_margin, _ = get_margins(template_shape[0])
+    left_margin, _ = get_margins(template_shape[1])
+    return img_statistics['top_margin'] - top_margin, img_statistics['left_margin'] - left_margin
+
+
+def _correlate(img_statistics, statistics):
+    """Cross-correlation of padded image (given by its FFT) with template, for every template center inside the image.
+
+    FFT size is at least padded image size, so circular correlation does not wrap around at these positions.
+    """
+    fft_shape = img_statistics['fft_shape']
+    conj_ffts = statistics['conj_ffts']
+    conj_template_fft = conj_ffts.get(fft_shape)
+    if conj_template_fft is None:
+        conj_template_fft = np.conj(np.fft.rfft2(statistics['template'], s=fft_shape))
+        conj_ffts[fft_shape] = conj_template_fft
+        # search windows of a tracker change size (and get clipped at frame borders), so shapes keep coming: drop least recently used
+        while len(conj_ffts) > CONJ_FFTS_CACHE_SIZE:
+            conj_ffts.popitem(last=False)
+    else:
+        conj_ffts.move_to_end(fft_shape)
+
+    correlation = np.fft.irfft2(img_statistics['padded_fft'] * conj_template_fft, s=fft_shape)
+    img_height, img_width = img_statistics['shape']
+    y_offset, x_offset = _template_offsets(img_statistics, statistics['template'].shape)
+    return correlation[y_offset:y_offset + img_height, x_offset:x_offset + img_width]
+
+
+def _template_match_map_fft(img_statistics, statistics, criteria_type):
+    """SSD and NCC for all positions at once: FFT correlation for sum(I*T), integral images for sum(I^2), sum(T^2) and valid pixels counts."""
+    img_height, img_width = img_statistics['shape']
+    template_height, template_width = statistics['template'].shape
+
+    sum_img_template = _correlate(img_statistics, statistics)
+    y_offset, x_offset = _template_offsets(img_statistics, statistics['template'].shape)
+    sum_img_sq = _box_sums(img_statistics['sq_integral'], y_offset, x_offset, img_height, img_width, template_height, template_width)
+
+    # template pixels that overlap the image form a rectangle, which shrinks near edges
+    rows_start, rows_end = _valid_ranges(img_height, template_height)
+    cols_start, cols_end = _valid_ranges(img_width, template_width)
+    sum_template_sq = _rectangle_sums(statistics['sq_integral'], rows_start, rows_end, cols_start, cols_end)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if criteria_type == 'ssd':
+            valid_counts = (rows_end - rows_start)[:, np.newaxis] * (cols_end - cols_start)[np.newaxis]
+            squared_differences = np.maximum(sum_img_sq - 2 * sum_img_template + sum_template_sq, 0)
+            criteria_values_map = squared_differences / valid_counts
+        else:  # ncc, valid counts of means cancel out
+            normalization = np.sqrt(sum_img_sq * sum_template_sq)
+            criteria_values_map = np.where(normalization > 0, sum_img_template / normalization, np.nan)
+
+    return criteria_values_map.astype(np.float32)
+
+
+def _template_match_map_sad(img_statistics, statistics):
+    """SAD for all positions: blocks of output rows accumulate |shifted zero padded image - template pixel| over template pixels, padding contribution subtracted analytically.
+
+    Every step is a contiguous vector operation over a block of rows small enough to stay in cache.
+    """
+    img_height, img_width = img_statistics['shape']
+    template = statistics['template_float32']
+    template_height, template_width = template.shape
+
+    y_offset, x_offset = _template_offsets(img_statistics, template.shape)
+    padded_img = img_statistics['padded_float32'][y_offset:, x_offset:]
+
+    rows_start, rows_end = _valid_ranges(img_height, template_height)
+    cols_start, cols_end = _valid_ranges(img_width, template_width)
+    valid_counts = (rows_end - rows_start)[:, np.newaxis] * (cols_end - cols_start)[np.newaxis]
+
+    # padding pixel contributes |0 - T| = |T|, which is total sum of |T| minus its sum over valid rectangle
+    abs_integral = statistics['abs_integral']
+    padding_contribution = abs_integral[-1, -1] - _rectangle_sums(abs_integral, rows_start, rows_end, cols_start, cols_end)
+
+    sum_abs_differences = np.empty((img_height, img_width), dtype=np.float64)
+    block_rows = max(1, SAD_BLOCK_ELEMENTS // img_width)
+    for y in range(0, img_height, block_rows):
+        rows = min(block_rows, img_height - y)
+        accumulator = np.zeros((rows, img_width), dtype=np.float32)
+        difference = np.empty((rows, img_width), dtype=np.float32)
+        for i in range(template_height):
+            padded_rows = padded_img[y + i:y + i + rows]
+            for j in range(template_width):
+                np.subtract(padded_rows[:, j:j + img_width], template[i, j], out=difference)
+                np.abs(difference, out=difference)
+                accumulator += difference
+        sum_abs_differences[y:y + rows] = accumulator
+
+    criteria_values_map = (sum_abs_differences - padding_contribution) / valid_counts
+    return criteria_values_map.astype(np.float32)
+
+
+def _template_match_map_shared(img_statistics, statistics, criteria_type):
+    if criteria_type == 'sad':
+        return _template_match_map_sad(img_statistics, statistics)
+    return _template_match_map_fft(img_statistics, statistics, criteria_type)
+
+
+def _template_match_map_loop(img, template, criteria):
+    """Reference implementation: criteria evaluated per pixel on NaN padded patches, works with any criteria function."""
     img_height, img_width = img.shape
     template_height, template_width = template.shape
 
@@ -51,6 +239,88 @@ def template_match_map(img, template, criteria):
     return criteria_values_map
 
 
+def template_match_map(img, template, criteria, statistics=None):
+    """Value of criteria for template centered at every pixel of the image, partial matching on edges (only pixels inside image count).
+
+    SAD, SSD and NCC are computed for all positions at once (vectorized engine), any other criteria - pixel by pixel.
+    statistics (output of template_statistics) can be passed to reuse template precomputation across images.
+    """
+    if criteria not in CRITERIA_TYPES:
+        return _template_match_map_loop(img, template, criteria)
+
+    if statistics is None:
+        statistics = template_statistics(template)
+    criteria_type = CRITERIA_TYPES[criteria]
+    return _template_match_map_shared(image_statistics(img, [template.shape], criteria_type), statistics, criteria_type)
+
+
+def template_match_maps(img, templates, criteria, templates_statistics=None, n_jobs=1):
+    """Same as template_match_map for a list of templates (of any sizes) against one image.
+
+    Padded image, its FFT and integral image are computed once and shared by all templates, templates can be processed by several threads.
+
+    Args:
+        img: numpy array float32, grayscale image
+        templates: list of numpy arrays float32, grayscale templates
+        criteria: SAD, SSD or NCC
+        templates_statistics: list of outputs of template_statistics for templates, to reuse across images. If None - calculate
+        n_jobs: int, number of threads, None - as many as CPU cores
+
+    Return:
+        criteria_values_maps: numpy array float32, of shape [number_of_templates, img_height, img_width]
+    """
+    criteria_type = CRITERIA_TYPES[criteria]
+    if templates_statistics is None:
+        templates_statistics = [template_statistics(template) for template in templates]
+    img_statistics = image_statistics(img, [template.shape for template in templates], criteria_type)
+
+    criteria_values_maps = np.empty((len(templates),) + img.shape, dtype=np.float32)
+
+    def match(i):
+        criteria_values_maps[i] = _template_match_map_shared(img_statistics, templates_statistics[i], criteria_type)
+
+    if n_jobs == 1:
+        for i in range(len(templates)):
+            match(i)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(match, range(len(templates))))
+    return criteria_values_maps
+
+
+def template_match_positions(img, templates, criteria, criteria_type, templates_statistics=None, n_jobs=1):
+    """Best position of every template in the image: list of template_match_position outputs, (center, value, bbox) per template."""
+    criteria_values_maps = template_match_maps(img, templates, criteria, templates_statistics=templates_statistics, n_jobs=n_jobs)
+    return [template_match_position(criteria_values_map, criteria_type, template) for criteria_values_map, template in zip(criteria_values_maps, templates)]
+
+
+def template_match_map_region(img, template, criteria, region, statistics=None):
+    """Same as template_match_map, but only for template centers inside region (x, y, width, height) of the image.
+
+    Image is cropped to the region extended by template margins, so that values are identical to respective part of the full map.
+    Cost depends on region size, not image size. Also returns (x, y) of the top-left map value in image coordinates (region clipped to image).
+    """
+    img_height, img_width = img.shape
+    top_margin, bottom_margin = get_margins(template.shape[0])
+    left_margin, right_margin = get_margins(template.shape[1])
+
+    x, y, w, h = region
+    x1, y1 = max(x, 0), max(y, 0)
+    x2, y2 = min(x + w, img_width), min(y + h, img_height)
+
+    # crop borders either coincide with image borders, or are out of reach of templates centered inside region
+    crop_x1, crop_y1 = max(x1 - left_margin, 0), max(y1 - top_margin, 0)
+    crop_x2, crop_y2 = min(x2 + right_margin, img_width), min(y2 + bottom_margin, img_height)
+
+    criteria_values_map = template_match_map(img[crop_y1:crop_y2, crop_x1:crop_x2], template, criteria, statistics=statistics)
+    return criteria_values_map[y1 - crop_y1:y2 - crop_y1, x1 - crop_x1:x2 - crop_x1], (x1, y1)
+
+
+def _extremum_sign(criteria_type):
+    """Sign that turns criteria into "smaller is better" (NCC is the only one to be maximized)."""
+    return -1 if criteria_type in ['ncc'] else 1
+
+
 def template_match_position(criteria_values_map, criteria_type, template):
     # default
     extremum = np.argmin
@@ -71,12 +341,88 @@ def template_match_position(criteria_values_map, criteria_type, template):
     return (cy, cx), value, bbox
 
 
+def best_positions(criteria_values_map, criteria_type, number_of_positions, min_distance):
+    """Best positions of the map (greedy non-maximum suppression: chosen ones are further than min_distance from each other), with their values."""
+    # NaN (undefined criteria) is the worst possible value
+    scores = np.nan_to_num(_extremum_sign(criteria_type) * criteria_values_map.astype(np.float64), nan=np.inf)
+    order = np.argsort(scores, axis=None, kind='stable')
+
+    positions = []
+    for flat_index in order:
+        y, x = np.unravel_index(flat_index, criteria_values_map.shape)
+        if all(max(abs(y - py), abs(x - px)) > min_distance for py, px in positions):
+            positions.append((y, x))
+            if len(positions) == number_of_positions:
+                break
+
+    return [((y, x), criteria_values_map[y, x]) for y, x in positions]
+
+
+def template_match_position_pyramid(img, template, criteria, criteria_type, levels=3, candidates=5, radius=2, min_template_side=4):
+    """Coarse-to-fine alternative to template_match_position(template_match_map(...)).
+
+    Downsampled template is matched exhaustively against downsampled image only at the coarsest level,
+    best candidates are kept, and at every finer level only (2*radius + 1)^2 neighbourhoods of candidates are evaluated.
+
+    Args:
+        img: numpy array float32, grayscale image
+        template: numpy array float32, grayscale template
+        criteria: SAD, SSD or NCC (or any function with the same interface)
+        criteria_type: string, 'sad', 'ssd' or 'ncc'
+        levels: int, number of pyramid levels including full resolution (1 - exhaustive search)
+        candidates: int, number of candidates kept between levels
+        radius: int, half size of neighbourhood to refine candidate in, at every finer level
+        min_template_side: int, pyramid is not built further once template side would get below this
+
+    Return:
+        same as template_match_position: (cy, cx), value, bbox
+    """
+    img_pyramid, template_pyramid = [img], [template]
+    while len(img_pyramid) < levels and min(template_pyramid[-1].shape) >= 2 * min_template_side:
+        img_pyramid.append(cv2.pyrDown(img_pyramid[-1]))
+        template_pyramid.append(cv2.pyrDown(template_pyramid[-1]))
+
+    statistics_pyramid = [template_statistics(level_template) if criteria in CRITERIA_TYPES else None for level_template in template_pyramid]
+
+    # exhaustive search at the coarsest level only
+    criteria_values_map = template_match_map(img_pyramid[-1], template_pyramid[-1], criteria, statistics=statistics_pyramid[-1])
+    best = best_positions(criteria_values_map, criteria_type, candidates, min_distance=radius)
+
+    sign = _extremum_sign(criteria_type)
+    for level in range(len(img_pyramid) - 2, -1, -1):
+        refined = []
+        for (y, x), _ in best:
+            # pyrDown halves coordinates, so candidate lands around doubled position at finer level
+            region = (2 * x - radius, 2 * y - radius, 2 * radius + 1, 2 * radius + 1)
+            local_map, (x1, y1) = template_match_map_region(img_pyramid[level], template_pyramid[level], criteria, region, statistics=statistics_pyramid[level])
+            (ly, lx), value = best_positions(local_map, criteria_type, 1, min_distance=0)[0]
+            refined.append(((y1 + ly, x1 + lx), value))
+
+        # the same position can be reached from several candidates
+        refined = list(dict(refined).items())
+        refined.sort(key=lambda position_value: np.nan_to_num(sign * float(position_value[1]), nan=np.inf))
+        best = refined[:candidates]
+
+    (cy, cx), value = best[0]
+
+    height, width = template.shape
+    top_shift, _ = get_margins(height)
+    left_shift, _ = get_margins(width)
+
+    bbox = (cx-left_shift, cy-top_shift, width, height)
+
+    return (cy, cx), value, bbox
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("img", help="string path to the image for which you would like to apply template matching")
     parser.add_argument("template", help="string path to the image to be used as template")
     parser.add_argument("criteria_type", help="which comparison method to use", choices=['sad', 'ssd', 'ncc'])
     parser.add_argument("--bbox", help="segment of template image to be actually used as template defined by coordinates of left top corner and height, width. If not supplied, the whole image to be used.", nargs=4, type=int)
+    parser.add_argument("--levels", help="number of pyramid levels for coarse-to-fine search, 1 - exhaustive search", type=int, default=1)
+    parser.add_argument("--candidates", help="number of candidates kept between pyramid levels", type=int, default=5)
+    parser.add_argument("--report", help="also run exhaustive search and report accuracy and speed of pyramid search against it", action='store_true')
 
     args = parser.parse_args()
 
@@ -105,10 +451,23 @@ if __name__ == "__main__":
         template_color = template_color[y:y + h, x:x + w]
         template = template[y:y + h, x:x + w]
 
-    criteria_values_map = template_match_map(img, template, criteria)
-    center, value, bbox = template_match_position(criteria_values_map, criteria_type, template)
+    start = time.perf_counter()
+    if args.levels > 1:
+        center, value, bbox = template_match_position_pyramid(img, template, criteria, criteria_type, levels=args.levels, candidates=args.candidates)
+    else:
+        criteria_values_map = template_match_map(img, template, criteria)
+        center, value, bbox = template_match_position(criteria_values_map, criteria_type, template)
+    elapsed = time.perf_counter() - start
     print("Center:", center, "Map value:", value, "BBox:", bbox)
 
+    if args.report:
+        start = time.perf_counter()
+        exhaustive_center, exhaustive_value, _ = template_match_position(template_match_map(img, template, criteria), criteria_type, template)
+        exhaustive_elapsed = time.perf_counter() - start
+        print(f"Exhaustive: center {exhaustive_center}, value {exhaustive_value}, {exhaustive_elapsed:.3f}s. "
+              f"Pyramid ({args.levels} levels): {elapsed:.3f}s ({exhaustive_elapsed / elapsed:.1f}x), "
+              f"center offset {np.hypot(center[0] - exhaustive_center[0], center[1] - exhaustive_center[1]):.1f} px, value difference {abs(value - exhaustive_value):.4g}")
+
     x, y, w, h = bbox
 
     cv2.rectangle(img_color, (x, y), (x+w, y+h), (255, 0, 0), 3)
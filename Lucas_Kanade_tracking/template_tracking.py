@@ -0,0 +1,135 @@
+import os
+import sys
+import cv2
+import time
+import numpy as np
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))  # repository root, for frame_source
+from frame_source import iter_frames, decode_frame
+from template_matching import SAD, SSD, NCC, get_margins, template_statistics, template_match_map_region, best_positions
+
+# per pixel criteria value that still counts as confident match (NCC - at least, SAD/SSD - at most; gray levels of 0..255 images)
+CONFIDENCE_THRESHOLDS = {'sad': 20., 'ssd': 400., 'ncc': 0.8}
+
+
+def track_template(frames, template, criteria, criteria_type, center, search_radius=16, max_search_radius=None, growth=2.,
+                   confidence_threshold=None, update_rate=0.):
+    """Track template through a sequence of frames, searching only a window around the previous match.
+
+    Template statistics (FFT, integral images) are computed once and reused, so per frame cost depends on window size, not frame size.
+    While matches are confident, window has search_radius; after an unconfident match it grows by factor growth (up to max_search_radius)
+    and shrinks back once the target is found confidently again.
+
+    Args:
+        frames: iterable of numpy arrays float32, grayscale frames
+        template: numpy array float32, grayscale template
+        criteria: SAD, SSD or NCC
+        criteria_type: string, 'sad', 'ssd' or 'ncc'
+        center: (cy, cx), template center in the first frame
+        search_radius: int, half size of search window (in pixels of template center displacement) while tracking is confident
+        max_search_radius: int, upper bound for growing window. If None - window may grow to the whole frame
+        growth: float, factor window radius is multiplied by after unconfident match
+        confidence_threshold: float, see CONFIDENCE_THRESHOLDS (default per criteria_type)
+        update_rate: float in [0, 1], on confident match template <- (1 - update_rate) * template + update_rate * matched patch. 0 - fixed template
+
+    Return (yield, per frame):
+        center: (cy, cx) template center
+        value: float, criteria value at center
+        bbox: x,y-coordinates of left-top corner, width, height
+        search_window: x, y, width, height of searched template centers
+        seconds: float, time spent on the frame
+    """
+    if confidence_threshold is None:
+        confidence_threshold = CONFIDENCE_THRESHOLDS[criteria_type]
+    sign = -1 if criteria_type in ['ncc'] else 1
+
+    template = template.astype(np.float32)
+    height, width = template.shape
+    top_shift, _ = get_margins(height)
+    left_shift, _ = get_margins(width)
+    statistics = template_statistics(template)
+
+    radius = search_radius
+    cy, cx = center
+    for frame in frames:
+        start = time.perf_counter()
+
+        search_window = (cx - radius, cy - radius, 2 * radius + 1, 2 * radius + 1)
+        local_map, (x1, y1) = template_match_map_region(frame, template, criteria, search_window, statistics=statistics)
+        (ly, lx), value = best_positions(local_map, criteria_type, 1, min_distance=0)[0]
+        cy, cx = y1 + ly, x1 + lx
+
+        confident = sign * value <= sign * confidence_threshold
+        if confident:
+            radius = search_radius
+            if update_rate > 0 and cy - top_shift >= 0 and cx - left_shift >= 0 and cy - top_shift + height <= frame.shape[0] and cx - left_shift + width <= frame.shape[1]:
+                patch = frame[cy - top_shift:cy - top_shift + height, cx - left_shift:cx - left_shift + width]
+                template = (1 - update_rate) * template + update_rate * patch
+                statistics = template_statistics(template)
+        else:
+            radius = int(radius * growth)
+            if max_search_radius is not None:
+                radius = min(radius, max_search_radius)
+            radius = min(radius, max(frame.shape))
+
+        bbox = (cx - left_shift, cy - top_shift, width, height)
+        yield (cy, cx), value, bbox, search_window, time.perf_counter() - start
+
+
+def read_gray_frames(frames_paths, frames=None):
+    """Lazily decode frames as float32 grayscale images.
+
+    Args:
+        frames_paths: list of strings, paths to frames
+        frames: iterable of numpy arrays uint8, grayscale frames to take instead of decoding frames_paths (e.g. frame_source.iter_frames with 'gray' conversion)
+    """
+    if frames is None:
+        frames = (decode_frame(path, 'gray') for path in frames_paths)
+    for frame in frames:
+        yield frame.astype(np.float32)
+
+
+# example queries:
+# ./imgs/Bolt/img ./imgs/Bolt/img/0001.jpg 336 165 26 61 ncc
+# ./imgs/Girl/img ./imgs/Girl/img/0001.jpg 57 21 31 45 ssd --update_rate 0.1
+# ./imgs/Bolt/img ./imgs/Bolt/img/0001.jpg 336 165 26 61 ncc --cache
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset", help="string path to the folder with frames to track through")
+    parser.add_argument("anchor", help="string path to the frame to take template from, usually first frame in sequence")
+    parser.add_argument("bbox", help="template region in anchor frame, x,y-coordinates of left-top corner, width, height", nargs=4, type=int)
+    parser.add_argument("criteria_type", help="which comparison method to use", choices=['sad', 'ssd', 'ncc'])
+    parser.add_argument("--search_radius", help="half size of search window while tracking is confident", type=int, default=16)
+    parser.add_argument("--max_search_radius", help="upper bound for growing search window", type=int, default=None)
+    parser.add_argument("--confidence_threshold", help="criteria value that still counts as confident match", type=float, default=None)
+    parser.add_argument("--update_rate", help="template update rate on confident matches, 0 - fixed template", type=float, default=0.)
+    parser.add_argument("--output", help="file to write per frame bboxes to (frame path, x, y, w, h, value)", default=None)
+    parser.add_argument("--cache", help="take decoded frames from the frame cache next to dataset folder, decoding (and caching) them on the first run",
+                        action='store_true')
+
+    args = parser.parse_args()
+
+    criteria = {'sad': SAD, 'ssd': SSD, 'ncc': NCC}[args.criteria_type]
+    frames_paths = [os.path.join(args.dataset, path) for path in sorted(os.listdir(args.dataset))]
+
+    x, y, w, h = args.bbox
+    anchor = cv2.imread(args.anchor, cv2.IMREAD_GRAYSCALE).astype(np.float32)
+    template = anchor[y:y + h, x:x + w]
+    center = (y + get_margins(h)[0], x + get_margins(w)[0])
+
+    output = open(args.output, 'w') if args.output else None
+    total_seconds = 0.
+    start = time.perf_counter()
+    cached_frames = iter_frames(args.dataset, 'gray', build_cache=True) if args.cache else None
+    for path, (_, value, bbox, _, seconds) in zip(frames_paths, track_template(read_gray_frames(frames_paths, cached_frames), template, criteria, args.criteria_type, center,
+                                                                             search_radius=args.search_radius, max_search_radius=args.max_search_radius,
+                                                                             confidence_threshold=args.confidence_threshold, update_rate=args.update_rate)):
+        total_seconds += seconds
+        if output:
+            output.write(f"{path},{bbox[0]},{bbox[1]},{bbox[2]},{bbox[3]},{value}\n")
+    wall_seconds = time.perf_counter() - start
+    if output:
+        output.close()
+
+    print(f"frames: {len(frames_paths)}, matching FPS: {len(frames_paths) / total_seconds:.1f}, end-to-end FPS (with decoding): {len(frames_paths) / wall_seconds:.1f}")
@@ -0,0 +1,207 @@
+import numpy as np
+import cv2
+import os
+import re
+import csv
+import glob
+import json
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))  # repository root, for frame_source
+from frame_source import iter_frames, build_frame_cache, decode_frame
+from meanShift import meanShift
+from camShift import camShift
+from moments import integral_moments
+from preprocessing import hue_histogram, back_project, search_region
+from motion_prediction import WindowPredictor, bounding_window, start_window
+
+TRACKER_TYPES = ['meanshift_cv2', 'camshift_cv2', 'meanshift_own', 'camshift_own']
+SUCCESS_THRESHOLD = 0.5  # IoU from which frame counts as tracked successfully
+FIELDS = ['sequence', 'groundtruth', 'tracker', 'frames', 'fps', 'tracking_fps', 'mean_iterations', 'fallbacks',
+          'mean_iou', 'success_rate', 'success_auc', 'seconds']
+
+
+# Headless benchmark of all trackers over all sequences of Visual Tracker Benchmark layout:
+#   imgs/<Sequence>/img/*.jpg
+#   imgs/<Sequence>/groundtruth_rect.txt  (or groundtruth_rect.1.txt, groundtruth_rect.2.txt, ... one per target)
+# every (sequence, target, tracker) runs in its own process, initialized with the first ground truth rectangle.
+# With --cache sequences are decoded once (frame_source.py) before the jobs start, and every job replays views of the cache.
+
+
+def read_groundtruth(path):
+    """Ground truth rectangles (x, y, w, h per frame), values separated by commas, tabs or spaces."""
+    with open(path, 'r') as f:
+        rows = [re.split(r'[,\s]+', line.strip()) for line in f if line.strip()]
+    return np.array(rows, dtype=np.float64)
+
+
+def find_sequences(imgs_folder):
+    """List of (sequence name, frames folder, ground truth file) found in imgs_folder."""
+    sequences = []
+    for name in sorted(os.listdir(imgs_folder)):
+        frames_folder = os.path.join(imgs_folder, name, 'img')
+        if not os.path.isdir(frames_folder):
+            continue
+        for groundtruth_path in sorted(glob.glob(os.path.join(imgs_folder, name, 'groundtruth_rect*.txt'))):
+            sequences.append((name, frames_folder, groundtruth_path))
+    return sequences
+
+
+def iou(window, rect):
+    """Intersection over union of two rectangles, x,y-coordinates of left-top corner, width, height."""
+    x1, y1 = max(window[0], rect[0]), max(window[1], rect[1])
+    x2, y2 = min(window[0] + window[2], rect[0] + rect[2]), min(window[1] + window[3], rect[1] + rect[3])
+    intersection = max(x2 - x1, 0) * max(y2 - y1, 0)
+    union = window[2] * window[3] + rect[2] * rect[3] - intersection
+    return intersection / union if union > 0 else 0.
+
+
+def run_tracker(frames_folder, groundtruth_path, tracker_type, stop_criteria, search_margin=32, cache=False, predict=False):
+    """Track the first ground truth rectangle through the sequence with one tracker (as demo.py does, headless).
+
+    Args:
+        cache: bool, whether to take frames from the frame cache (if it is valid, decoded from files otherwise)
+        predict: bool, whether to start tracker of every frame from the window predicted by motion_prediction.WindowPredictor
+
+    Return:
+        windows: list of tracked windows per frame
+        stats: dict, 'iterations' - total number of iterations (None if tracker does not tell), 'fallbacks' - whole image fallbacks
+               (own trackers only), 'seconds' - end-to-end time, 'tracking_seconds' - time without reading frames
+    """
+    groundtruth = read_groundtruth(groundtruth_path)
+    if cache:
+        frames = iter_frames(frames_folder, 'bgr')
+    else:
+        # decode_frame raises on unreadable frames, instead of ending the sequence early (results of a truncated run would look valid)
+        frames = (decode_frame(os.path.join(frames_folder, path), 'bgr') for path in sorted(os.listdir(frames_folder)))
+
+    start = time.perf_counter()
+    first = next(frames)
+    track_window = tuple(int(v) for v in groundtruth[0])
+    roi_hist = hue_histogram(first, track_window)
+
+    own_tracker = tracker_type in ['meanshift_own', 'camshift_own']
+    tracker = meanShift if tracker_type == 'meanshift_own' else camShift
+    second_order = tracker_type == 'camshift_own'
+    cv2_term_crit = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, stop_criteria['max_iter'], stop_criteria['epsilon'])
+
+    timings = {'hsv': 0., 'back_projection': 0.}
+    stats = {'iterations': 0 if tracker_type != 'camshift_cv2' else None, 'fallbacks': 0 if own_tracker else None}
+    tracking_seconds = 0.
+    integrals = None
+    windows = []
+    predictor = WindowPredictor(track_window) if predict else None
+    for i in range(len(groundtruth)):
+        img = first if i == 0 else next(frames, None)
+        if img is None:
+            break
+        frame_start = time.perf_counter()
+        predicted = predictor.predict(img.shape[:2]) if predictor is not None else None
+
+        if own_tracker:
+            def full_integrals(img=img):
+                return integral_moments(back_project(img, roi_hist, timings), second_order=second_order)
+
+            x1, y1, x2, y2 = search_region(track_window if predicted is None else bounding_window(predicted, track_window), search_margin, img.shape[:2])
+            dst = back_project(img[y1:y2, x1:x2], roi_hist, timings)
+            integrals = integral_moments(dst, second_order=second_order, out=integrals, offset=(x1, y1), shape=img.shape[:2], full=full_integrals)
+            if predicted is not None:
+                track_window = start_window(predicted, track_window, integrals=integrals)
+            _, track_window = tracker(None, track_window, stop_criteria, integrals=integrals, stats=stats)
+        else:
+            dst = back_project(img, roi_hist, timings)
+            if predicted is not None:
+                track_window = start_window(predicted, track_window, prob_image=dst)
+            if tracker_type == 'meanshift_cv2':
+                iterations, track_window = cv2.meanShift(dst, track_window, cv2_term_crit)
+                stats['iterations'] += iterations
+            else:
+                _, track_window = cv2.CamShift(dst, track_window, cv2_term_crit)
+
+        track_window = tuple(int(v) for v in track_window)
+        if predictor is not None:
+            predictor.update(track_window)
+        tracking_seconds += time.perf_counter() - frame_start
+        windows.append(track_window)
+
+    stats['seconds'] = time.perf_counter() - start
+    stats['tracking_seconds'] = tracking_seconds
+    return windows, stats
+
+
+def benchmark(job):
+    """Run one (sequence, ground truth, tracker) job and summarize it into a single record (see FIELDS)."""
+    name, frames_folder, groundtruth_path, tracker_type, stop_criteria, search_margin, cache, predict = job
+    windows, stats = run_tracker(frames_folder, groundtruth_path, tracker_type, stop_criteria, search_margin, cache, predict)
+    groundtruth = read_groundtruth(groundtruth_path)[:len(windows)]
+
+    # frames where target is absent (or annotation is missing) are skipped
+    valid = np.all(np.isfinite(groundtruth), axis=1) & (groundtruth[:, 2] > 0) & (groundtruth[:, 3] > 0)
+    ious = np.array([iou(window, rect) for window, rect, v in zip(windows, groundtruth, valid) if v])
+    thresholds = np.linspace(0, 1, 21)
+    frames = len(windows)
+
+    return {
+        'sequence': name,
+        'groundtruth': os.path.basename(groundtruth_path),
+        'tracker': tracker_type,
+        'frames': frames,
+        'fps': frames / stats['seconds'],
+        'tracking_fps': frames / stats['tracking_seconds'] if stats['tracking_seconds'] > 0 else None,
+        'mean_iterations': stats['iterations'] / frames if stats['iterations'] is not None else None,
+        'fallbacks': stats['fallbacks'],
+        'mean_iou': float(ious.mean()) if len(ious) else None,
+        'success_rate': float(np.mean(ious > SUCCESS_THRESHOLD)) if len(ious) else None,
+        'success_auc': float(np.mean([np.mean(ious > threshold) for threshold in thresholds])) if len(ious) else None,
+        'seconds': stats['seconds'],
+    }
+
+
+if __name__ == "__main__":
+    # run from project folder (Mean_shift_tracking), sequences are expected in imgs (see README.md)
+    # fps are measured while other jobs run in parallel, use --n_jobs 1 for comparable numbers
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--imgs", help="folder with sequences", default='imgs')
+    parser.add_argument("--sequences", help="names of sequences to run, default all found", nargs='+', default=None)
+    parser.add_argument("--trackers", help="trackers to run", nargs='+', choices=TRACKER_TYPES, default=TRACKER_TYPES)
+    parser.add_argument("--max_iter", help="maximum number of iterations inside tracker per one frame", type=int, default=10)
+    parser.add_argument("--epsilon", help="distance boundary for convergence in tracker", type=float, default=1)
+    parser.add_argument("--search_margin", help="own trackers: pixels around the last window to back-project", type=int, default=32)
+    parser.add_argument("--cache", help="decode every sequence once into the frame cache and replay frames from it", action='store_true')
+    parser.add_argument("--predict", help="start trackers from Kalman predicted windows instead of the last ones", action='store_true')
+    parser.add_argument("--n_jobs", help="number of worker processes, default number of cpus", type=int, default=None)
+    parser.add_argument("--json", help="file to write results to as JSON", default='benchmark.json')
+    parser.add_argument("--csv", help="file to write results to as CSV", default='benchmark.csv')
+
+    args = parser.parse_args()
+
+    stop_criteria = {'max_iter': args.max_iter, 'epsilon': args.epsilon}
+    sequences = [sequence for sequence in find_sequences(args.imgs) if args.sequences is None or sequence[0] in args.sequences]
+    jobs = [(name, frames_folder, groundtruth_path, tracker_type, stop_criteria, args.search_margin, args.cache, args.predict)
+            for name, frames_folder, groundtruth_path in sequences for tracker_type in args.trackers]
+
+    start = time.perf_counter()
+    if args.cache:
+        # built here, so that parallel jobs of the same sequence do not race to write it
+        for frames_folder in sorted(set(sequence[1] for sequence in sequences)):
+            build_frame_cache(frames_folder, 'bgr')
+    with ProcessPoolExecutor(args.n_jobs) as executor:
+        records = list(executor.map(benchmark, jobs))
+    elapsed = time.perf_counter() - start
+
+    with open(args.json, 'w') as f:
+        json.dump({'max_iter': args.max_iter, 'epsilon': args.epsilon, 'search_margin': args.search_margin, 'predict': args.predict, 'results': records}, f, indent=2)
+    with open(args.csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+
+    def show(value):
+        return '-' if value is None else f"{value:.3f}" if isinstance(value, float) else str(value)
+
+    for record in records:
+        print(", ".join(f"{field}: {show(record[field])}" for field in FIELDS if field != 'seconds'))
+    print(f"{len(jobs)} runs in {elapsed:.1f}s")
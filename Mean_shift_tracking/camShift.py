@@ -4,26 +4,29 @@ import numpy as np
 import cv2
 
 from meanShift import meanShift
+from moments import window_moments
 
 MARGIN = 5  # number of pixels from each side to step outside from initial window
 DELTA = 1e-7
 MIN_SIDE_LENGTH = 10  # how low we allow width or height to be
 
 
-def camShift(prob_image, window, stop_criteria):
+def camShift(prob_image, window, stop_criteria, integrals=None, stats=None):
     """Update (tracking) window using cam-shift algorithm.
     Args:
-        prob_image: numpy array, of probabilities that given pixel belongs to tracked object
+        prob_image: numpy array, of probabilities that given pixel belongs to tracked object. Not used if integrals are given (may be None then)
         window: == bounding box: x,y-coordinates of left-top corner, width, height; enclosing prior tracked region
         stop_criteria: dict, where 'max_iter' - maximum number of iterations to run mean shift updates, so that we do not stuck eternally, 'epsilon' - max shift value under which we assume convergence.
+        integrals: dict, output of moments.integral_moments(prob_image, second_order=True). If None - moments are summed directly (see meanShift)
+        stats: dict, if given, mean shift 'iterations' and whole image 'fallbacks' are added to it (see meanShift)
     Return:
         ret: bool, whether process converged (True), or has been stopped after maximum number of iterations (False)
         window: updated bounding box
     """
-    prob_image_height, prob_image_width = prob_image.shape
+    prob_image_height, prob_image_width = integrals['shape'] if integrals is not None else prob_image.shape
 
     # run mean-shift algorithm until convergence
-    ret, window = meanShift(prob_image, window, stop_criteria)
+    ret, window = meanShift(prob_image, window, stop_criteria, integrals=integrals, stats=stats)
 
     # if mean-shift indeed converged, resize (tracking) window, otherwise just return output of mean-shift
     if ret:
@@ -41,8 +44,10 @@ def camShift(prob_image, window, stop_criteria):
         x1 = np.maximum(x, 0)
         x2 = np.minimum(x + w, prob_image_width)
 
-        roi = prob_image[y1:y2, x1:x2]
-        M = cv2.moments(roi)
+        if integrals is not None:
+            M = window_moments(integrals, x1, y1, x2, y2)
+        else:
+            M = cv2.moments(prob_image[y1:y2, x1:x2])
 
         # if it suddenly is smaller, then we have a lot of trouble, so just keep to the output of mean-shift
         if M['m00'] > DELTA:
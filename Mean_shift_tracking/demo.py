@@ -3,10 +3,19 @@
 import numpy as np
 import cv2
 import os
+import sys
+import time
 import argparse
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))  # repository root, for frame_source
+from frame_source import iter_frames
 from meanShift import meanShift
 from camShift import camShift
+from moments import integral_moments
+from preprocessing import back_project, search_region, prefetch_back_projections
+from motion_prediction import WindowPredictor, bounding_window, start_window
+
+STAGES = ['read', 'hsv', 'back_projection', 'wait', 'track', 'display']
 
 
 # example queries:
@@ -15,6 +24,9 @@ from camShift import camShift
 # ./imgs/Skating2/img ./imgs/Skating2/img/0001.jpg 347 58 103 251 camshift_own 10 1
 # ./imgs/BlurFace/img ./imgs/BlurFace/img/0001.jpg 246 226 94 114 meanshift_cv2 10 1
 # ./imgs/Board/img ./imgs/Board/img/00001.jpg 57 156 198 173 camshift_own 10 1
+# ./imgs/Girl/img ./imgs/Girl/img/0001.jpg 57 21 31 45 meanshift_own 10 1 --headless --output girl_bboxes.txt
+# ./imgs/Girl/img ./imgs/Girl/img/0001.jpg 57 21 31 45 meanshift_own 10 1 --headless --cache
+# ./imgs/BlurCar2/img ./imgs/BlurCar2/img/0001.jpg 227 207 122 99 meanshift_own 10 1 --predict
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("dataset", help="string path to the folder with images to apply tracking")
@@ -23,6 +35,16 @@ if __name__ == "__main__":
     parser.add_argument("tracker", help="which tracker to use", choices=['meanshift_cv2', 'camshift_cv2', 'meanshift_own', 'camshift_own'])
     parser.add_argument("max_iter", help="maximum number of iterations inside tracker per one frame", type=int)
     parser.add_argument("epsilon", help="distance boundary for convergence in tracker", type=float)
+    parser.add_argument("--headless", help="no GUI calls, per frame bboxes are written to --output instead", action='store_true')
+    parser.add_argument("--output", help="file to write per frame bboxes to (frame path, x, y, w, h), default bboxes.txt in headless mode", default=None)
+    parser.add_argument("--queue_size", help="how many preprocessed frames background reader may keep ahead of the tracker", type=int, default=8)
+    parser.add_argument("--delay", help="milliseconds to wait for a key press after displaying each frame", type=int, default=30)
+    parser.add_argument("--search_margin", help="own trackers: pixels around the last window to back-project (the whole frame only if tracker needs it), "
+                                                "negative - always back-project the whole frame", type=int, default=32)
+    parser.add_argument("--cache", help="take decoded frames from the frame cache next to dataset folder, decoding (and caching) them on the first run",
+                        action='store_true')
+    parser.add_argument("--predict", help="start tracker of every frame from the window predicted by constant velocity Kalman filter, "
+                                          "instead of the last window", action='store_true')
 
     args = parser.parse_args()
 
@@ -32,6 +54,8 @@ if __name__ == "__main__":
     tracker_type = args.tracker
     max_iter = args.max_iter
     epsilon = args.epsilon
+    headless = args.headless
+    output_path = args.output if args.output is not None else ('bboxes.txt' if headless else None)
 
     # set tracker and stopping criteria
     tracker = None
@@ -49,6 +73,17 @@ if __name__ == "__main__":
         tracker = camShift
         term_crit = {'max_iter': max_iter, 'epsilon': epsilon}
 
+    # own trackers work on moments tables covering only the search region around the last window (unless search_margin is negative)
+    own_tracker = tracker_type in ['meanshift_own', 'camshift_own']
+    second_order = tracker_type == 'camshift_own'
+    region_limited = own_tracker and args.search_margin >= 0
+    integrals = None
+    full_back_projections = 0
+
+    # iterations (own trackers and meanshift_cv2) and lost track fallbacks (own trackers) over all frames
+    stats = {'iterations': 0, 'fallbacks': 0}
+    predictor = WindowPredictor(track_window) if args.predict else None
+
     # retrieve paths to all frames
     dataset_img_paths = [os.path.join(dataset_path, img_path) for img_path in sorted(os.listdir(dataset_path))]
 
@@ -70,21 +105,91 @@ if __name__ == "__main__":
     cv2.normalize(roi_hist, roi_hist, 0, 255, cv2.NORM_MINMAX)
 
     # display region of interest
-    cv2.imshow('roi', roi)
-
-    for i, img_path in enumerate(dataset_img_paths):
-        # read next frame and convert it to probability image
-        img = cv2.imread(img_path, cv2.IMREAD_COLOR)
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-        dst = cv2.calcBackProject([hsv], [0], roi_hist, [0, 180], 1)
+    if not headless:
+        cv2.imshow('roi', roi)
+
+    output = open(output_path, 'w') if output_path else None
+    timings = {stage: 0. for stage in STAGES}
+    number_of_frames = 0
+    start = time.perf_counter()
+
+    # frames are read (and converted to probability images, unless only search region is) in background, while current one is tracked
+    cached_frames = iter_frames(dataset_path, 'bgr', build_cache=True) if args.cache else None
+    frames = prefetch_back_projections(dataset_img_paths, None if region_limited else roi_hist, queue_size=args.queue_size, frames=cached_frames)
+    for img_path in dataset_img_paths:
+        stage_start = time.perf_counter()
+        try:
+            img, dst, frame_timings = next(frames)
+        except StopIteration:
+            break
+        stage_end = time.perf_counter()
+        timings['wait'] += stage_end - stage_start
+        for stage, seconds in frame_timings.items():
+            timings[stage] += seconds
+
+        # search starts where the object is expected to be by now (unless the last window looks more promising, see start_window)
+        predicted = predictor.predict(img.shape[:2]) if predictor is not None else None
+
+        if region_limited:
+            # back projection of the whole frame only when tracker looks outside of search region (e.g. lost track fallback)
+            def full_integrals(img=img):
+                global full_back_projections
+                full_back_projections += 1
+                return integral_moments(back_project(img, roi_hist, timings), second_order=second_order)
+
+            x1, y1, x2, y2 = search_region(track_window if predicted is None else bounding_window(predicted, track_window), args.search_margin, img.shape[:2])
+            dst = back_project(img[y1:y2, x1:x2], roi_hist, timings)
+
+        # apply selected tracker (time of back projections it asks for goes to their stages)
+        preprocessing = timings['hsv'] + timings['back_projection']
+        stage_start = time.perf_counter()
+        if region_limited:
+            integrals = integral_moments(dst, second_order=second_order, out=integrals, offset=(x1, y1), shape=img.shape[:2], full=full_integrals)
+            if predicted is not None:
+                track_window = start_window(predicted, track_window, integrals=integrals)
+            ret, track_window = tracker(None, track_window, term_crit, integrals=integrals, stats=stats)
+        elif own_tracker:
+            # whole frame back projection: the few windows tracker looks at are cheaper to sum directly than to build tables of the frame
+            if predicted is not None:
+                track_window = start_window(predicted, track_window, prob_image=dst)
+            ret, track_window = tracker(dst, track_window, term_crit, stats=stats)
+        else:
+            if predicted is not None:
+                track_window = start_window(predicted, track_window, prob_image=dst)
+            ret, track_window = tracker(dst, track_window, term_crit)
+            if tracker_type == 'meanshift_cv2':
+                stats['iterations'] += ret
+        stage_end = time.perf_counter()
+        timings['track'] += stage_end - stage_start - (timings['hsv'] + timings['back_projection'] - preprocessing)
+        number_of_frames += 1
+        if predictor is not None:
+            predictor.update(track_window)
 
-        # apply selected tracker
-        ret, track_window = tracker(dst, track_window, term_crit)
+        x, y, w, h = track_window
+        if output:
+            output.write(f"{img_path},{x},{y},{w},{h}\n")
 
         # display tracking result
-        x, y, w, h = track_window
-        cv2.rectangle(img, (x, y), (x + w, y + h), (255, 0, 0), 2)
-        cv2.imshow('track', img)
-        k = cv2.waitKey(30) & 0xff
-        if k == 27:
-            break
+        if not headless:
+            stage_start = stage_end
+            img = img.copy() if not img.flags.writeable else img
+            cv2.rectangle(img, (x, y), (x + w, y + h), (255, 0, 0), 2)
+            cv2.imshow('track', img)
+            k = cv2.waitKey(max(args.delay, 1)) & 0xff
+            timings['display'] += time.perf_counter() - stage_start
+            if k == 27:
+                break
+    frames.close()
+
+    elapsed = time.perf_counter() - start
+    if output:
+        output.close()
+
+    # read (hsv and back projection too, unless region limited) run in background, overlapping with the rest; wait is how long tracker starved for frames
+    number_of_frames = max(number_of_frames, 1)
+    print(f"frames: {number_of_frames}, end-to-end FPS: {number_of_frames / elapsed:.1f}" +
+          (f", whole frame back projections: {full_back_projections}" if region_limited else ""))
+    if tracker_type != 'camshift_cv2':
+        print(f"iterations per frame: {stats['iterations'] / number_of_frames:.2f}" +
+              (f", lost track fallbacks: {stats['fallbacks']}" if own_tracker else ""))
+    print("per frame, ms: " + ", ".join(f"{stage} {1000 * timings[stage] / number_of_frames:.2f}" for stage in STAGES))
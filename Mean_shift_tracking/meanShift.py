@@ -3,16 +3,23 @@
 import numpy as np
 import cv2
 
+from moments import integral_moments, window_moments
+
 DELTA = 1e-7  # float literal, alias for "small enough to cause troubles with division"
+TABLES_COST = 20  # building summed-area tables of an image costs about as much as cv2.moments of this many whole images
 
 
-def meanShift(prob_image, window, stop_criteria):
+def meanShift(prob_image, window, stop_criteria, integrals=None, stats=None):
     """Update (tracking) window using mean-shift algorithm.
 
     Args:
-        prob_image: numpy array, of probabilities that given pixel belongs to tracked object
+        prob_image: numpy array, of probabilities that given pixel belongs to tracked object. Not used if integrals are given (may be None then)
         window: == bounding box: x,y-coordinates of left-top corner, width, height; enclosing prior tracked region
         stop_criteria: dict, where 'max_iter' - maximum number of iterations to run mean shift updates, so that we do not stuck eternally, 'epsilon' - max shift value under which we assume convergence.
+        integrals: dict, output of moments.integral_moments(prob_image), to share between trackers of the same frame.
+                   If None - moments of windows are summed directly (cv2.moments), tables are built here only once windows summed so far
+                   add up to more pixels than building them costs (many iterations, whole image fallbacks; see TABLES_COST)
+        stats: dict, if given, number of mean shift 'iterations' and of whole image 'fallbacks' (lost track) are added to it
 
     Return:
         ret: bool, whether process converged (True), or has been stopped after maximum number of iterations (False)
@@ -21,10 +28,31 @@ def meanShift(prob_image, window, stop_criteria):
     max_iter = stop_criteria['max_iter']
     epsilon = stop_criteria['epsilon']
 
-    prob_image_height, prob_image_width = prob_image.shape
+    prob_image_height, prob_image_width = integrals['shape'] if integrals is not None else prob_image.shape
+
+    def moments(x1, y1, x2, y2):
+        """Moments of prob_image[y1:y2, x1:x2] (in relative system of coordinates)."""
+        nonlocal integrals, pixels_summed
+        if integrals is None and pixels_summed > TABLES_COST * prob_image.size:
+            # moments of any window (and of the whole image) are O(1) lookups from now on
+            integrals = integral_moments(prob_image)
+        if integrals is not None:
+            return window_moments(integrals, x1, y1, x2, y2)
+        roi = prob_image[y1:y2, x1:x2]
+        pixels_summed += roi.size
+        return cv2.moments(roi)
+
+    pixels_summed = 0
+
+    if stats is not None:
+        stats.setdefault('iterations', 0)
+        stats.setdefault('fallbacks', 0)
 
     ret = False
     for i in range(max_iter):
+        if stats is not None:
+            stats['iterations'] += 1
+
         # retrieve relevant values
         x, y, w, h = window
 
@@ -34,16 +62,15 @@ def meanShift(prob_image, window, stop_criteria):
         x1 = np.maximum(x, 0)
         x2 = np.minimum(x+w, prob_image_width)
 
-        # select region of interest
-        roi = prob_image[y1:y2, x1:x2]
-
-        # find center of masses in region of interest (in relative system of coordinates)
-        M = cv2.moments(roi)
+        # find center of masses in region of interest prob_image[y1:y2, x1:x2] (in relative system of coordinates)
+        M = moments(x1, y1, x2, y2)
 
         # if there is not enough intensity in roi to reliably calculate center of mass, then most likely we lost track
         if M['m00'] < DELTA:
             # try the whole probability image to regain track
-            M = cv2.moments(prob_image)
+            if stats is not None:
+                stats['fallbacks'] += 1
+            M = moments(0, 0, prob_image_width, prob_image_height)
 
             # if probability low for the whole image, well, nothing to do, keep the last known (tracking) window
             # otherwise take the hint
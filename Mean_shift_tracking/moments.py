@@ -0,0 +1,135 @@
+import numpy as np
+import cv2
+
+
+# Summed-area tables (integral images) of p, x*p, y*p (and x*x*p, x*y*p, y*y*p), built once per probability image,
+# so that moments of any window are a few lookups, regardless of window size.
+# For integer probability images (output of cv2.calcBackProject) all sums are exact integers, hence raw moments of a window
+# are identical to cv2.moments of the same window; central moments are derived from them as in cv2.moments (up to round-off).
+# Tables may cover only a region of the frame (e.g. search region around the last window), with a callback that provides tables
+# of the whole frame once a window leaves the region (or the whole frame is asked for), so the rest is computed only if needed.
+
+
+def integral_moments(prob_image, second_order=False, out=None, offset=(0, 0), shape=None, full=None):
+    """Build summed-area tables of probability image for window_moments.
+
+    Args:
+        prob_image: numpy array, of probabilities that given pixel belongs to tracked object
+        second_order: bool, whether to build tables for m20, m11, m02 (needed by camShift)
+        out: dict, integrals of previous probability image of the same shape, its tables are overwritten.
+             Tracking loops should pass it: filling fresh frame-sized arrays costs several times more than the sums themselves
+        offset: x, y-coordinates of prob_image left-top corner in the frame, if it is only a region of the frame
+        shape: height, width of the frame. If None - prob_image is the whole frame
+        full: callable without arguments, returning integral_moments of the whole frame; called (once) when a window is not within the region
+
+    Return:
+        integrals: dict, where 'shape' - height and width of the frame, 'region' - x1, y1, x2, y2 of prob_image in the frame, 'exact' - whether sums are exact integers,
+                   'm00', 'm10', 'm01' - [height + 1, width + 1] tables of p, x*p, y*p,
+                   'm20', 'm11', 'm02' (only if asked) - [height + 1, width + 1] tables of x*x*p, x*y*p, y*y*p,
+                   'buffer' - scratch space
+    """
+    height, width = prob_image.shape
+    exact = np.issubdtype(prob_image.dtype, np.integer)
+
+    x = np.arange(width, dtype=np.float64)
+    y = np.arange(height, dtype=np.float64)[:, np.newaxis]
+    p = prob_image if prob_image.dtype == np.uint8 else prob_image.astype(np.float64)
+
+    if out is None or out['buffer'].shape != (height, width):
+        out = {'buffer': np.empty((height, width), dtype=np.float64)}
+    integrals = out
+    integrals['shape'] = (height, width) if shape is None else tuple(shape)
+    integrals['region'] = (offset[0], offset[1], offset[0] + width, offset[1] + height)
+    integrals['full'] = full
+    integrals['exact'] = exact
+    buffer = integrals['buffer']
+
+    def integral(name, *weights):
+        src = p
+        for weight in weights:
+            src = np.multiply(weight, src, out=buffer)
+        table = integrals.get(name)
+        if table is None or table.dtype != np.float64:
+            table = np.empty((height + 1, width + 1), dtype=np.float64)
+        integrals[name] = cv2.integral(src, table, sdepth=cv2.CV_64F)
+
+    # float64 holds these sums exactly, as long as they stay below 2**53 (for integer images of any practical size they do)
+    integral('m00')
+    integral('m10', x)
+    integral('m01', y)
+
+    if not second_order:
+        for name in ['m20', 'm11', 'm02']:
+            integrals.pop(name, None)
+    else:
+        # the largest of second order sums is bounded by max(x, y)**2 * sum(p)
+        if not exact or max(width - 1, height - 1)**2 * integrals['m00'][-1, -1] < 2**53:
+            integral('m20', x * x)
+            integral('m11', x, y)
+            integral('m02', y * y)
+        else:
+            p = prob_image.astype(np.int64)
+            x, y = x.astype(np.int64), y.astype(np.int64)
+            for name, values in [('m20', x * x * p), ('m11', x * y * p), ('m02', y * y * p)]:
+                table = np.zeros((height + 1, width + 1), dtype=np.int64)
+                np.cumsum(values, axis=0, out=table[1:, 1:])
+                np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+                integrals[name] = table
+
+    return integrals
+
+
+def _box(table, x1, y1, x2, y2):
+    return table[y2, x2].item() - table[y1, x2].item() - table[y2, x1].item() + table[y1, x1].item()
+
+
+def window_moments(integrals, x1, y1, x2, y2):
+    """Moments of prob_image[y1:y2, x1:x2] in its own system of coordinates, same as cv2.moments of that slice.
+
+    Args:
+        integrals: dict, output of integral_moments
+        x1, y1, x2, y2: ints, window corners in the frame (x2, y2 exclusive), interpreted exactly as slice bounds of the frame would be
+
+    Return:
+        M: dict with 'm00', 'm10', 'm01', and if integrals have second order tables also 'm20', 'm11', 'm02', 'mu20', 'mu11', 'mu02'
+    """
+    height, width = integrals['shape']
+    x1, x2, _ = slice(int(x1), int(x2)).indices(width)
+    y1, y2, _ = slice(int(y1), int(y2)).indices(height)
+    empty = x1 >= x2 or y1 >= y2
+
+    rx1, ry1, rx2, ry2 = integrals['region']
+    if not empty and not (rx1 <= x1 and ry1 <= y1 and x2 <= rx2 and y2 <= ry2):
+        if integrals['full'] is None:
+            raise ValueError(f"window {(x1, y1, x2, y2)} is outside of region {integrals['region']} and there is no way to get the whole frame")
+        integrals['full'] = integrals['full']() if callable(integrals['full']) else integrals['full']
+        return window_moments(integrals['full'], x1, y1, x2, y2)
+
+    # tables are in region coordinates
+    x1, x2, y1, y2 = (0, 0, 0, 0) if empty else (x1 - rx1, x2 - rx1, y1 - ry1, y2 - ry1)
+
+    # exact sums are continued with python ints, so that shifting to window coordinates does not round either
+    number = int if integrals['exact'] else float
+    s00, s10, s01 = (number(_box(integrals[name], x1, y1, x2, y2)) for name in ['m00', 'm10', 'm01'])
+    m00 = s00
+    m10 = s10 - x1*s00
+    m01 = s01 - y1*s00
+    M = {'m00': float(m00), 'm10': float(m10), 'm01': float(m01)}
+
+    if 'm20' in integrals:
+        s20, s11, s02 = (number(_box(integrals[name], x1, y1, x2, y2)) for name in ['m20', 'm11', 'm02'])
+        M['m20'] = float(s20 - 2*x1*s10 + x1*x1*s00)
+        M['m11'] = float(s11 - x1*s01 - y1*s10 + x1*y1*s00)
+        M['m02'] = float(s02 - 2*y1*s01 + y1*y1*s00)
+
+        # central moments, as cv2.moments derives them
+        cx = cy = 0.
+        if abs(M['m00']) > np.finfo(np.float64).eps:
+            inv_m00 = 1. / M['m00']
+            cx = M['m10'] * inv_m00
+            cy = M['m01'] * inv_m00
+        M['mu20'] = M['m20'] - M['m10']*cx
+        M['mu11'] = M['m11'] - M['m10']*cy
+        M['mu02'] = M['m02'] - M['m01']*cy
+
+    return M
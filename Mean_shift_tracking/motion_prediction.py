@@ -0,0 +1,91 @@
+import numpy as np
+
+from filterpy.kalman import KalmanFilter
+from moments import window_moments
+
+
+# Constant velocity Kalman filter over the window center (as in Kalman_filter/mouseCapture.py: state [x, vx, y, vy], one step = one frame).
+# Before a frame is tracked, the window is moved to where the filter expects the object to be, so that mean shift starts close to
+# the mode instead of at the last position (fewer iterations, fast objects do not leave the window, i.e. fewer lost track fallbacks).
+# Center of the window tracker converged to is the measurement the filter is updated with.
+# Constant velocity overshoots when object abruptly turns, then predicted window may miss the object entirely and mean shift drifts
+# to the background, so tracker starts from whichever of predicted and last windows covers more probability mass (a lookup, given integrals).
+
+
+class WindowPredictor:
+    """Predict where tracking window moves next frame, from centers of windows tracked so far.
+
+    Args:
+        window: x,y-coordinates of left-top corner, width, height; tracking window in the first frame
+        process_noise: float, variance of velocity change per frame (pixels^2), higher - follows acceleration faster
+        measurement_noise: float, variance of tracked window center (pixels^2), higher - smoother, slower to react
+    """
+    def __init__(self, window, process_noise=4., measurement_noise=4.):
+        x, y, w, h = (int(v) for v in window)
+        self.size = (w, h)
+
+        self.kalman_filter = KalmanFilter(dim_x=4, dim_z=2)     # dim_x <-> [x, vx, y, vy] and dim_z <-> [x, y]
+        self.kalman_filter.x = np.array([[x + 0.5*w],
+                                         [0.],
+                                         [y + 0.5*h],
+                                         [0.]])
+        self.kalman_filter.F = np.array([[1., 1., 0., 0.],
+                                         [0., 1., 0., 0.],
+                                         [0., 0., 1., 1.],
+                                         [0., 0., 0., 1.]])     # State transition matrix: [x + vx; vx; y + vy; vy]
+        self.kalman_filter.H = np.array([[1., 0., 0., 0.],
+                                         [0., 0., 1., 0.]])     # Measurement matrix: only center is measured
+        self.kalman_filter.R = np.eye(2) * measurement_noise   # Measurement uncertainty
+        self.kalman_filter.Q = np.diag([0., process_noise, 0., process_noise])  # Process uncertainty
+        self.kalman_filter.P = np.diag([1., 100., 1., 100.])   # Covariance matrix (initial): position known, velocity not at all
+
+    def predict(self, shape=None):
+        """Advance the filter by one frame.
+
+        Args:
+            shape: height, width of the frame. If given - predicted center is kept within the frame
+
+        Return:
+            window: predicted tracking window (size of the last tracked window)
+        """
+        self.kalman_filter.predict()
+        cx, cy = self.kalman_filter.x[0, 0], self.kalman_filter.x[2, 0]
+        if shape is not None:
+            height, width = shape
+            cx = min(max(cx, 0.), width - 1.)
+            cy = min(max(cy, 0.), height - 1.)
+        w, h = self.size
+        return int(round(cx - 0.5*w)), int(round(cy - 0.5*h)), w, h
+
+    def update(self, window):
+        """Correct the filter with the window tracker converged to in this frame."""
+        x, y, w, h = (int(v) for v in window)
+        self.size = (w, h)
+        self.kalman_filter.update(np.array([[x + 0.5*w],
+                                            [y + 0.5*h]]))
+
+
+def bounding_window(*windows):
+    """Smallest window containing all the windows (e.g. to search around both predicted and last windows)."""
+    x1 = min(int(x) for x, y, w, h in windows)
+    y1 = min(int(y) for x, y, w, h in windows)
+    x2 = max(int(x + w) for x, y, w, h in windows)
+    y2 = max(int(y + h) for x, y, w, h in windows)
+    return x1, y1, x2 - x1, y2 - y1
+
+
+def window_mass(window, integrals=None, prob_image=None):
+    """Total probability within window (clipped to the frame), from integrals (see moments.integral_moments) or probability image."""
+    x, y, w, h = (int(v) for v in window)
+    x1, y1 = max(x, 0), max(y, 0)
+    x2, y2 = max(x + w, x1), max(y + h, y1)
+    if integrals is not None:
+        return window_moments(integrals, x1, y1, x2, y2)['m00']
+    return float(prob_image[y1:y2, x1:x2].sum())
+
+
+def start_window(predicted, last, integrals=None, prob_image=None):
+    """Window to start tracker from: predicted one, unless the last one covers more probability mass."""
+    if window_mass(last, integrals, prob_image) > window_mass(predicted, integrals, prob_image):
+        return tuple(int(v) for v in last)
+    return predicted
@@ -0,0 +1,108 @@
+import cv2
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))  # repository root, for frame_source
+from frame_source import prefetch
+from meanShift import meanShift
+from camShift import camShift
+from moments import integral_moments
+from preprocessing import hue_histogram, search_region, read_frames
+
+TRACKERS = {'meanshift': meanShift, 'camshift': camShift}
+
+
+# Several objects tracked through the same frames: each frame is decoded and converted to HSV once,
+# then every target back-projects its own hue histogram only over its search region of that shared HSV frame
+# (the whole frame only when its tracker looks outside, e.g. lost track fallback), and runs its tracker on that.
+# Per frame cost is one decode and one color conversion plus a small, target sized, part per target.
+
+
+def _track_target(target, hsv, tracker, stop_criteria, search_margin):
+    """Back-project target histogram over its search region of shared HSV frame, update target window with tracker."""
+    shape = hsv.shape[:2]
+    second_order = tracker is camShift
+
+    def full_integrals():
+        return integral_moments(cv2.calcBackProject([hsv], [0], target['hist'], [0, 180], 1), second_order=second_order)
+
+    x1, y1, x2, y2 = search_region(target['window'], search_margin, shape)
+    dst = cv2.calcBackProject([hsv[y1:y2, x1:x2]], [0], target['hist'], [0, 180], 1)
+    target['integrals'] = integral_moments(dst, second_order=second_order, out=target['integrals'], offset=(x1, y1), shape=shape, full=full_integrals)
+    ret, target['window'] = tracker(None, target['window'], stop_criteria, integrals=target['integrals'])
+    return ret, target['window']
+
+
+def track_multiple(frames, targets, tracker, stop_criteria, search_margin=32, n_jobs=1):
+    """Track several objects through a sequence of frames, sharing decoding and color conversion between them.
+
+    Args:
+        frames: iterable of numpy arrays uint8, BGR frames
+        targets: list of (bbox, roi_hist), where bbox - x,y-coordinates of left-top corner, width, height in the first frame,
+                 roi_hist - hue histogram of the target (see hue_histogram)
+        tracker: meanShift or camShift
+        stop_criteria: dict, where 'max_iter' - maximum number of iterations per frame, 'epsilon' - max shift value under which we assume convergence.
+        search_margin: int, pixels around the last window to back-project for each target
+        n_jobs: int, number of worker threads targets are tracked with (cv2 calls release GIL), 1 - no threads, None - as many as CPU cores
+
+    Return (yield, per frame):
+        results: list of (ret, window) per target, in order of targets
+    """
+    states = [{'window': tuple(bbox), 'hist': roi_hist, 'integrals': None} for bbox, roi_hist in targets]
+    executor = None if n_jobs == 1 else ThreadPoolExecutor(n_jobs)
+    try:
+        for img in frames:
+            hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+            if executor is None:
+                results = [_track_target(state, hsv, tracker, stop_criteria, search_margin) for state in states]
+            else:
+                results = list(executor.map(lambda state: _track_target(state, hsv, tracker, stop_criteria, search_margin), states))
+            yield results
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+# example query (two targets):
+# ./imgs/Girl/img ./imgs/Girl/img/0001.jpg meanshift 10 1 --bbox 57 21 31 45 --bbox 120 30 30 40 --output girl_bboxes.txt
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset", help="string path to the folder with images to apply tracking")
+    parser.add_argument("anchor", help="string path to the image to take targets from, usually first image in sequence")
+    parser.add_argument("tracker", help="which tracker to use", choices=list(TRACKERS))
+    parser.add_argument("max_iter", help="maximum number of iterations inside tracker per one frame", type=int)
+    parser.add_argument("epsilon", help="distance boundary for convergence in tracker", type=float)
+    parser.add_argument("--bbox", help="region of interest to track, x,y-coordinates of left-top corner, width, height; once per target",
+                        nargs=4, type=int, action='append', required=True)
+    parser.add_argument("--search_margin", help="pixels around the last window to back-project", type=int, default=32)
+    parser.add_argument("--n_jobs", help="number of worker threads to track targets with", type=int, default=1)
+    parser.add_argument("--queue_size", help="how many decoded frames background reader may keep ahead of the tracker", type=int, default=8)
+    parser.add_argument("--output", help="file to write per frame bboxes to (frame path, target index, x, y, w, h)", default=None)
+
+    args = parser.parse_args()
+
+    dataset_img_paths = [os.path.join(args.dataset, img_path) for img_path in sorted(os.listdir(args.dataset))]
+    anchor_img = cv2.imread(args.anchor, cv2.IMREAD_COLOR)
+    targets = [(bbox, hue_histogram(anchor_img, bbox)) for bbox in args.bbox]
+    stop_criteria = {'max_iter': args.max_iter, 'epsilon': args.epsilon}
+
+    output = open(args.output, 'w') if args.output else None
+    number_of_frames = 0
+    start = time.perf_counter()
+    frames = prefetch(read_frames(dataset_img_paths), args.queue_size)
+    for img_path, results in zip(dataset_img_paths, track_multiple(frames, targets, TRACKERS[args.tracker], stop_criteria,
+                                                                   search_margin=args.search_margin, n_jobs=args.n_jobs)):
+        number_of_frames += 1
+        if output:
+            for i, (_, (x, y, w, h)) in enumerate(results):
+                output.write(f"{img_path},{i},{x},{y},{w},{h}\n")
+    elapsed = time.perf_counter() - start
+    if output:
+        output.close()
+
+    number_of_frames = max(number_of_frames, 1)
+    print(f"targets: {len(targets)}, frames: {number_of_frames}, end-to-end FPS: {number_of_frames / elapsed:.1f}, "
+          f"ms per frame: {1000 * elapsed / number_of_frames:.2f}")
@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+import numpy as np
+import cv2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))  # repository root, for frame_source
+from frame_source import prefetch
+
+
+# Frame preprocessing shared by demo.py, multi_tracking.py and benchmark.py: reading frames (ahead of the tracker),
+# hue histogram of the target and back projection of it over the whole frame or over the search region around the window.
+
+
+def hue_histogram(img, bbox):
+    """Hue histogram (step = 1 degree, scaled to 0..255) of region of interest, dark and poorly saturated pixels discarded."""
+    x, y, w, h = bbox
+    hsv_roi = cv2.cvtColor(img[y:y + h, x:x + w], cv2.COLOR_BGR2HSV)
+    mask = cv2.inRange(hsv_roi, np.array((0., 60., 32.)), np.array((180., 255., 255.)))
+    roi_hist = cv2.calcHist([hsv_roi], [0], mask, [180], [0, 180])
+    cv2.normalize(roi_hist, roi_hist, 0, 255, cv2.NORM_MINMAX)
+    return roi_hist
+
+
+def back_project(img, roi_hist, timings):
+    """Probability image of img (whole frame or its region) given hue histogram, time of both steps is added to timings."""
+    start = time.perf_counter()
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    hsv_done = time.perf_counter()
+    dst = cv2.calcBackProject([hsv], [0], roi_hist, [0, 180], 1)
+    timings['hsv'] += hsv_done - start
+    timings['back_projection'] += time.perf_counter() - hsv_done
+    return dst
+
+
+def search_region(window, margin, shape):
+    """Window expanded by margin from each side, clipped to the frame: x1, y1, x2, y2 (exclusive)."""
+    x, y, w, h = (int(v) for v in window)
+    height, width = shape
+    x1 = min(max(x - margin, 0), width)
+    y1 = min(max(y - margin, 0), height)
+    x2 = max(min(x + w + margin, width), x1)
+    y2 = max(min(y + h + margin, height), y1)
+    return x1, y1, x2, y2
+
+
+def read_frames(imgs_paths):
+    """Decode frames as BGR images, one by one."""
+    for img_path in imgs_paths:
+        img = cv2.imread(img_path, cv2.IMREAD_COLOR)
+        if img is None:
+            raise IOError(f"could not read {img_path}")
+        yield img
+
+
+def _back_projections(frames, roi_hist):
+    source = iter(frames)
+    while True:
+        start = time.perf_counter()
+        img = next(source, None)
+        if img is None:
+            return
+        timings = {'read': time.perf_counter() - start, 'hsv': 0., 'back_projection': 0.}
+        dst = None if roi_hist is None else back_project(img, roi_hist, timings)
+        yield img, dst, timings
+
+
+def prefetch_back_projections(imgs_paths, roi_hist, queue_size=8, frames=None):
+    """Read frames, convert them to HSV and back-project hue histogram in a background thread (see frame_source.prefetch), ahead of the tracker.
+
+    cv2 releases GIL in imread, cvtColor and calcBackProject, so that preprocessing of upcoming frames overlaps with tracking.
+
+    Args:
+        imgs_paths: list of strings, paths to frames
+        roi_hist: numpy array, hue histogram of region of interest. If None - frames are only read (back projection is up to the tracker)
+        queue_size: int, how many preprocessed frames may wait for the tracker (bounds memory)
+        frames: iterable of numpy arrays uint8, BGR frames to take instead of reading imgs_paths (e.g. frame_source.iter_frames)
+
+    Return (yield, per frame):
+        img: numpy array uint8, BGR frame (read-only view if frames come from the cache)
+        dst: numpy array uint8, back projection (probability image), None if roi_hist is None
+        timings: dict, seconds spent on 'read', 'hsv' and 'back_projection' of this frame
+    """
+    return prefetch(_back_projections(read_frames(imgs_paths) if frames is None else frames, roi_hist), queue_size)
@@ -0,0 +1,219 @@
+import os
+import json
+import queue
+import threading
+import numpy as np
+import cv2
+
+
+# Reading of frame sequences shared by the tracking projects (Mean_shift_tracking, Lucas_Kanade_tracking):
+# decoded frame cache (iter_frames) and decoding ahead of the tracker in a background thread (prefetch).
+# Their scripts run from their own folders, and add the repository root to sys.path to import this module.
+
+
+# Decoded frames of an image sequence, cached next to the frames folder as two files sharing the same base path:
+#   <frames_folder>.<conversion>.npy   - uint8 array [number_of_frames, height, width(, 3)], opened memory-mapped (frames are zero-copy views)
+#   <frames_folder>.<conversion>.json  - header: conversion, shape, and name/mtime/size of every source file
+# header is written last (and atomically), so that an interrupted build leaves no valid cache behind.
+# Cache is valid only while the folder lists the very same files, otherwise frames are decoded from the files again.
+CONVERSIONS = ['bgr', 'gray', 'hsv']
+MATRIX_SUFFIX = '.npy'
+HEADER_SUFFIX = '.json'
+
+
+def cache_path(frames_folder, conversion):
+    """Base path of the cache (without suffix) of frames folder and conversion."""
+    return f'{os.path.normpath(frames_folder)}.{conversion}'
+
+
+def _entries(frames_folder):
+    """Name, modification time (ns) and size (bytes) of every file in frames folder, in order of frames."""
+    entries = []
+    for name in sorted(os.listdir(frames_folder)):
+        stat = os.stat(os.path.join(frames_folder, name))
+        entries.append({'name': name, 'mtime': stat.st_mtime_ns, 'size': stat.st_size})
+    return entries
+
+
+def decode_frame(path, conversion):
+    """Read image file and convert it: 'bgr' - as is, 'gray' - grayscale, 'hsv' - HSV (as cv2.cvtColor with COLOR_BGR2HSV)."""
+    if conversion == 'gray':
+        frame = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    else:
+        frame = cv2.imread(path, cv2.IMREAD_COLOR)
+    if frame is None:
+        raise IOError(f"could not read {path}")
+    if conversion == 'hsv':
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    return frame
+
+
+def load_frame_cache(frames_folder, conversion='bgr'):
+    """Open cached frames of the folder, if cache exists and still matches files of the folder.
+
+    Return:
+        frames: numpy memmap uint8 (read-only), of shape [number_of_frames, height, width(, 3)], or None if there is no valid cache
+    """
+    base_path = cache_path(frames_folder, conversion)
+    if not os.path.exists(base_path + HEADER_SUFFIX):
+        return None
+
+    with open(base_path + HEADER_SUFFIX, 'r') as f:
+        header = json.load(f)
+    if header['conversion'] != conversion or header['entries'] != _entries(frames_folder):
+        return None
+
+    frames = np.load(base_path + MATRIX_SUFFIX, mmap_mode='r')
+    if list(frames.shape) != header['shape']:
+        return None
+    return frames
+
+
+def iter_frames(frames_folder, conversion='bgr', build_cache=False):
+    """Frames of the folder in order: views of the cache if it is valid, decoded from files otherwise.
+
+    Args:
+        frames_folder: string, path to the folder with frames (every file is a frame, sorted by name)
+        conversion: string, one of CONVERSIONS
+        build_cache: bool, whether to store frames decoded from files into a new cache along the way.
+                     Cache is committed once all frames were decoded (before the last one is yielded), if they have the same shape
+
+    Return (yield, per frame):
+        frame: numpy array uint8 (read-only view of memory map when read from the cache)
+    """
+    frames = load_frame_cache(frames_folder, conversion)
+    if frames is not None:
+        yield from frames
+        return
+
+    entries = _entries(frames_folder)
+    base_path = cache_path(frames_folder, conversion)
+    matrix = None
+    for i, entry in enumerate(entries):
+        frame = decode_frame(os.path.join(frames_folder, entry['name']), conversion)
+
+        if build_cache:
+            if matrix is None:
+                matrix = np.lib.format.open_memmap(base_path + MATRIX_SUFFIX, mode='w+', dtype=np.uint8, shape=(len(entries),) + frame.shape)
+            if frame.shape != matrix.shape[1:]:
+                # frames of different size do not fit single array, just stream
+                build_cache = False
+                del matrix
+                matrix = None
+                os.remove(base_path + MATRIX_SUFFIX)
+            else:
+                matrix[i] = frame
+
+        if matrix is not None and i == len(entries) - 1:
+            # committed before the last frame is yielded, consumers often stop right after it (e.g. zip with the paths of frames)
+            matrix.flush()
+            header = {'conversion': conversion, 'shape': list(matrix.shape), 'entries': entries}
+            del matrix
+            matrix = None
+            with open(base_path + '.tmp' + HEADER_SUFFIX, 'w') as f:
+                json.dump(header, f)
+            os.replace(base_path + '.tmp' + HEADER_SUFFIX, base_path + HEADER_SUFFIX)
+
+        yield frame
+
+
+def build_frame_cache(frames_folder, conversion='bgr'):
+    """Decode all frames of the folder into the cache (unless it is valid already) and open it.
+
+    Return:
+        frames: numpy memmap uint8 (read-only), of shape [number_of_frames, height, width(, 3)], None if frames differ in size
+    """
+    for _ in iter_frames(frames_folder, conversion, build_cache=True):
+        pass
+    return load_frame_cache(frames_folder, conversion)
+
+
+class _Error:
+    """Exception raised by the source, passed to the consumer through the queue (so that it is not mistaken for an item)."""
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def prefetch(items, queue_size=8):
+    """Consume iterable in a background thread, keeping at most queue_size items ahead of the consumer.
+
+    Whatever work the iterable does per item (e.g. a generator decoding frames) is done by the background thread,
+    cv2 releases GIL in imread, cvtColor, calcBackProject etc., so that it overlaps with the consumer.
+    Stopping early (break, close, exception in the consumer) never leaves the background thread blocked on a full queue.
+
+    Args:
+        items: iterable, source of items
+        queue_size: int, how many items may wait for the consumer (bounds memory)
+
+    Return (yield):
+        item: items of the iterable in order; exception raised by the iterable is raised to the consumer
+    """
+    ready = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        """Wait for room in the queue, unless consumer stops meanwhile. Return whether item was put."""
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker():
+        # items, the error and the end marker all go through put, so that a consumer that stopped early never leaves the worker blocked
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_Error(e))
+            return
+        put(end)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is end:
+                break
+            if isinstance(item, _Error):
+                raise item.exception
+            yield item
+    finally:
+        # consumer stopped early (or finished): let the worker exit
+        stop.set()
+        thread.join()
+
+
+if __name__ == "__main__":
+    # decode sequences once, e.g. before benchmarking: python frame_source.py Mean_shift_tracking/imgs/Girl/img Lucas_Kanade_tracking/imgs/Bolt/img --conversions bgr gray hsv
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("frames_folders", help="folders with frames of sequences", nargs='+')
+    parser.add_argument("--conversions", help="which conversions to cache", nargs='+', choices=CONVERSIONS, default=['bgr'])
+
+    args = parser.parse_args()
+
+    for frames_folder in args.frames_folders:
+        for conversion in args.conversions:
+            start = time.perf_counter()
+            frames = build_frame_cache(frames_folder, conversion)
+            built = time.perf_counter() - start
+
+            start = time.perf_counter()
+            checksum = sum(int(frame[0, 0].sum()) for frame in iter_frames(frames_folder, conversion))
+            replayed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for path in sorted(os.listdir(frames_folder)):
+                decode_frame(os.path.join(frames_folder, path), conversion)
+            decoded = time.perf_counter() - start
+
+            shape = None if frames is None else frames.shape
+            print(f"{frames_folder} ({conversion}): {shape}, build {built:.2f}s, replay from cache {replayed:.3f}s, decode {decoded:.2f}s")